@@ -4,25 +4,49 @@ import os
 import nest_asyncio
 import pytz
 import threading
+import time
 import json
-import pandas as pd
+import hashlib
+import io
+import csv
+import gzip
+import zipfile
+import itertools
+import bisect
+import importlib.util
+import math
+import sys
+from collections import deque, Counter
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, CancelledError
 import telegram.error
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, ChatPermissions, \
     BotCommand, BotCommandScopeDefault, BotCommandScopeChat, Bot
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, CallbackContext, \
-    ContextTypes
+    ContextTypes, TypeHandler
 from datetime import datetime, timedelta
-from flask import Flask
-from openpyxl import load_workbook
-from openpyxl.styles import Alignment, Border, Side, PatternFill
-from apscheduler.schedulers.background import BackgroundScheduler
-import os
-from datetime import datetime
-import pandas as pd
-from openpyxl.styles import PatternFill
-from telegram import Update
-from telegram.ext import CallbackContext
+# pandas, openpyxl та flask потрібні лише для звітів та веб-сторінки - вони імпортуються при першому використанні,
+# щоб не сповільнювати запуск бота (див. bench_startup.py)
+
+
+class LazyModule:
+    """Модуль, який імпортується при першому зверненні до його атрибутів"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:  # Перше звернення може статися одночасно з циклу подій та з потоку Excel
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+pd = LazyModule("pandas")
 
 nest_asyncio.apply()
 
@@ -93,6 +117,10 @@ def safe_json_write(data, file_path):
             os.replace(temp_file, file_path)
         else:
             os.rename(temp_file, file_path)
+
+        if file_path == DATA_FILE:
+            global data_version
+            data_version += 1
         return True
     except Exception as e:
         print(f"Write failed: {e}")
@@ -103,6 +131,14 @@ def safe_json_write(data, file_path):
             pass
         return False
 
+def read_side_file(file_path):
+    """Читання допоміжного JSON файлу поруч із data.json; None, якщо його ще немає або він пошкоджений"""
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
 # ДОПОМІЖНІ ФУНКЦІЇ
 def get_current_time_kiev():
     """Отримання поточного часу у Києві"""
@@ -110,32 +146,19 @@ def get_current_time_kiev():
     now = datetime.now(kiev_tz)
     return now.strftime("%H:%M; %d/%m/%Y")
 
-def load_muted_users_from_file():
-    """Завантаження списку замучених користувачів"""
-    data = safe_json_read(DATA_FILE)
-    muted_users = {}
-
-    for user in data.get("users", []):
-        try:
-            if user.get("mute", False):
-                mute_end = user.get("mute_end")
-                if mute_end:
-                    try:
-                        mute_end = datetime.strptime(mute_end, "%H:%M; %d/%m/%Y")
-                    except:
-                        mute_end = None
-
-                muted_users[user["id"]] = {
-                    "first_name": user.get("first_name", ""),
-                    "username": user.get("username", ""),
-                    "expiration": mute_end,
-                    "reason": user.get("reason", "")
-                }
-        except KeyError as e:
-            print(f"Invalid user format: {e}")
-            continue
+def parse_kiev_time(value):
+    """Розбір дати у форматі "%H:%M; %d/%m/%Y" (None, якщо формат інший)"""
+    try:
+        return datetime.strptime(value, "%H:%M; %d/%m/%Y")
+    except (TypeError, ValueError):
+        return None
 
-    return muted_users
+def escape_markdown(text):
+    """Екранування спецсимволів для MarkdownV2"""
+    if not text:
+        return ""
+    escape_chars = r'_*[]()~`>#+-=|{}.!'
+    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
 
 def load_sent_messages():
     """Завантаження відправлених повідомлень"""
@@ -153,383 +176,1412 @@ def load_users_info():
     data = safe_json_read(DATA_FILE)
     return data.get("users", [])
 
-def load_chat_id_from_file():
+def load_chat_id_from_file(data=None):
     """Завантаження ID чату"""
-    data = safe_json_read(DATA_FILE)
+    data = data if data is not None else safe_json_read(DATA_FILE)
     return data.get("chat_id", "")
 
-def load_bottocen_from_file():
+def load_bottocen_from_file(data=None):
     """Завантаження токену бота"""
-    data = safe_json_read(DATA_FILE)
+    data = data if data is not None else safe_json_read(DATA_FILE)
     return data.get("bot_token", "")
 
 
-def load_allusers_tem_id_from_file():
+def load_allusers_tem_id_from_file(data=None):
     """Завантаження ID теми для всіх користувачів"""
-    data = safe_json_read(DATA_FILE)
+    data = data if data is not None else safe_json_read(DATA_FILE)
     return data.get("allusers_tem_id", 386)  # Значення за замовчуванням 386
 
-def load_cave_chat_id_from_file():
+def load_cave_chat_id_from_file(data=None):
     """Завантаження ID печерного чату"""
-    data = safe_json_read(DATA_FILE)
+    data = data if data is not None else safe_json_read(DATA_FILE)
     return data.get("cave_chat_id", -1002648725095)  # Значення за замовчуванням -1002648725095
 
+def load_ack_mode_from_file(data=None):
+    """Завантаження режиму підтвердження доставки ("reaction" або "text")"""
+    data = data if data is not None else safe_json_read(DATA_FILE)
+    return data.get("ack_mode", "reaction")
+
+def load_coalesce_window_from_file(data=None):
+    """Завантаження вікна об'єднання повідомлень користувача в секундах (0 - вимкнено)"""
+    data = data if data is not None else safe_json_read(DATA_FILE)
+    return float(data.get("coalesce_window", 1.5))
+
+def load_rate_limit_from_file(data=None):
+    """Завантаження налаштувань обмеження частоти повідомлень від користувачів"""
+    data = data if data is not None else safe_json_read(DATA_FILE)
+    settings = {
+        "burst": 8,  # Скільки повідомлень поспіль можна надіслати
+        "refill_per_sec": 0.5,  # Швидкість відновлення токенів
+        "mute_after_drops": 15,  # Після скількох відкинутих повідомлень видається автоматичний мут
+        "mute_seconds": 600
+    }
+    settings.update(data.get("rate_limit", {}))
+    return settings
+
+def load_dedup_settings_from_file(data=None):
+    """Завантаження налаштувань придушення дублікатів повідомлень"""
+    data = data if data is not None else safe_json_read(DATA_FILE)
+    settings = {
+        "user_window": 60,  # Вікно (сек) для повторів від одного користувача
+        "global_window": 600,  # Вікно (сек) для однакового вмісту від різних користувачів
+        "global_users": 3,  # Скільки різних користувачів надсилають те саме, щоб вважати це спамом
+        "global_min_length": 20,  # Короткі тексти ("привіт") не вважаються глобальними дублікатами
+        "simhash_distance": 10,  # Максимальна відстань Хеммінга для схожих текстів
+        "simhash_min_tokens": 4,
+        "simhash_min_length": 100,  # Схожі (не однакові) тексти різних користувачів порівнюються лише для довгих
+        "max_recent": 2000,  # Обмеження пам'яті глобального вікна
+        "report_interval_minutes": 10
+    }
+    settings.update(data.get("dedup", {}))
+    return settings
+
+def load_reconcile_settings_from_file(data=None):
+    """Завантаження налаштувань узгодження стану модерації з чатом"""
+    data = data if data is not None else safe_json_read(DATA_FILE)
+    settings = {
+        "concurrency": 10,  # Скільки запитів до Telegram виконується одночасно
+        "per_second": 30,  # Загальний темп запитів (ліміт Telegram - близько 30 на секунду)
+        "retries": 3,  # Повтори після RetryAfter
+        "progress_interval": 2  # Як часто (сек) оновлювати повідомлення з прогресом
+    }
+    settings.update(data.get("reconcile", {}))
+    return settings
+
+def load_report_settings_from_file(data=None):
+    """Завантаження налаштувань нічних звітів у чат збереження"""
+    data = data if data is not None else safe_json_read(DATA_FILE)
+    settings = {
+        "delta": True,  # Між повними звітами надсилати лише зміни
+        "full_every_days": 7  # Як часто (днів) надсилати повний Excel файл
+    }
+    settings.update(data.get("reports", {}))
+    return settings
 
-def is_programmer(username):
-    """Перевірка, чи є користувач програмістом"""
-    data = safe_json_read(DATA_FILE)
-    return username in data.get("programmers", [])
 
-def is_admin(username):
-    """Перевірка, чи є користувач адміністратором"""
-    data = safe_json_read(DATA_FILE)
-    return username in data.get("admins", [])
+def mute_user_in_data(data, user_id, mute_time, reason):
+    """Запис стану муту користувача в дані (без збереження у файл)"""
+    mute_end = (datetime.now() + timedelta(seconds=mute_time)).strftime("%H:%M; %d/%m/%Y")
+    user_data = next((u for u in data["users"] if u["id"] == user_id), None)
+    if user_data:
+        user_data.update({
+            "mute": True,
+            "mute_end": mute_end,
+            "reason": reason
+        })
+
+    data["muted_users"][user_id] = {
+        "expiration": mute_end,
+        "reason": reason
+    }
+    return mute_end
+
+# СТАТИСТИКА
+def get_today_kiev():
+    """Поточна дата у Києві для денних лічильників"""
+    return datetime.now(pytz.timezone('Europe/Kiev')).strftime("%Y-%m-%d")
+
+def rebuild_stats(data):
+    """Повний перерахунок лічильників статистики з даних (при першому запуску та після імпорту)"""
+    banned_ids = set(data.get("banned_users", {}))
+    ratings = Counter()
+    for user in data.get("users", []):
+        try:
+            rating = float(user.get("rating") or 0)
+        except (TypeError, ValueError):
+            continue
+        if rating > 0:
+            ratings[str(rating)] += 1
+
+    previous = data.get("stats", {})
+    return {
+        "users": len(data.get("users", [])),
+        "muted": len(set(data.get("muted_users", {})) - banned_ids),
+        "banned": len(banned_ids),
+        "topics": len(data.get("topics", {})),
+        "ratings": dict(ratings),
+        "relayed_date": previous.get("relayed_date", get_today_kiev()),
+        "relayed_in_today": previous.get("relayed_in_today", 0),
+        "relayed_out_today": previous.get("relayed_out_today", 0),
+        "relayed_total": previous.get("relayed_total", 0),
+    }
+
+def load_stats_from_file(data=None):
+    """Завантаження збережених лічильників статистики (зі STATS_FILE; старі версії тримали їх у data.json)"""
+    data = data if data is not None else safe_json_read(DATA_FILE)
+    stats = read_side_file(STATS_FILE) or data.get("stats")
+    if not isinstance(stats, dict) or "users" not in stats or "ratings" not in stats:
+        stats = rebuild_stats(data)
+    return stats
+
+def stats_bump(key, delta=1):
+    """Зміна лічильника статистики на місці"""
+    STATS[key] = STATS.get(key, 0) + delta
+    stats_state["dirty"] = True
+
+async def save_stats():
+    """Збереження лічильників статистики в окремий файл, не чіпаючи data.json і його кеші.
+    Знімок береться в циклі подій, запис - у фоновому потоці"""
+    stats_state["dirty"] = False
+    snapshot = dict(STATS, ratings=dict(STATS["ratings"]))
+    if not await asyncio.to_thread(safe_json_write, snapshot, STATS_FILE):
+        stats_state["dirty"] = True
+
+def load_last_seen_from_file(data=None):
+    """Завантаження часу останньої активності користувачів (з LAST_SEEN_FILE; старі версії тримали його в users[])"""
+    last_seen = read_side_file(LAST_SEEN_FILE)
+    if last_seen is None:
+        data = data if data is not None else safe_json_read(DATA_FILE)
+        last_seen = {user["id"]: user["last_seen"] for user in data.get("users", []) if user.get("last_seen")}
+    return last_seen
+
+async def save_last_seen():
+    """Збереження часу останньої активності в окремий файл: не переписує data.json і не скидає його кеші"""
+    seen_state["dirty"] = False
+    seen_state["flushed_at"] = time.monotonic()
+    if not await asyncio.to_thread(safe_json_write, dict(last_seen_times), LAST_SEEN_FILE):
+        seen_state["dirty"] = True
+
+def stats_rating_changed(previous_rating, new_rating):
+    """Оновлення гістограми оцінок при зміні оцінки користувача"""
+    ratings = STATS["ratings"]
+    if previous_rating:
+        key = str(float(previous_rating))
+        ratings[key] = max(0, ratings.get(key, 0) - 1)
+    if new_rating:
+        key = str(float(new_rating))
+        ratings[key] = ratings.get(key, 0) + 1
+    stats_state["dirty"] = True
+
+def stats_count_relay(direction):
+    """Облік пересланого повідомлення ("in" - від користувача, "out" - від адміністрації)"""
+    today = get_today_kiev()
+    if STATS.get("relayed_date") != today:
+        STATS.update({"relayed_date": today, "relayed_in_today": 0, "relayed_out_today": 0})
+    stats_bump(f"relayed_{direction}_today")
+    stats_bump("relayed_total")
+
+# МОДЕЛІ ЗАПИСІВ
+# Компактні записи для даних, які тримаються в пам'яті між запитами (індекси списків, представлення модерації).
+# Обробники й далі читають і пишуть data.json як словники; записи будуються з них через from_json,
+# а записи модерації повертаються у файл через to_json
+NOT_SPECIFIED = "Не вказано"
+
+def kiev_time_to_epoch(value):
+    """Дата у форматі "%H:%M; %d/%m/%Y" -> секунди епохи (None, якщо формат інший)"""
+    parsed = parse_kiev_time(value)
+    return int(parsed.timestamp()) if parsed else None
+
+def epoch_to_kiev_time(value):
+    """Секунди епохи -> дата у форматі "%H:%M; %d/%m/%Y" (None залишається None)"""
+    return datetime.fromtimestamp(value).strftime("%H:%M; %d/%m/%Y") if value is not None else None
+
+def shared_text(value):
+    """Повторювані значення (причини, "Не вказано") зберігаються в одному екземплярі"""
+    return sys.intern(value) if isinstance(value, str) else value
+
+def record_rating(value):
+    """Оцінка як число: 5 залишається 5, 4.5 - 4.5, некоректні значення - 0"""
+    try:
+        rating = float(value or 0)
+    except (TypeError, ValueError):
+        return 0
+    return int(rating) if rating.is_integer() else rating
+
+@dataclass(slots=True)
+class UserRecord:
+    """Користувач з users[]: id - число, дата заходу - секунди епохи"""
+    id: int
+    username: str
+    first_name: str
+    joined: int | None
+    rating: float
+
+    @classmethod
+    def from_json(cls, user):
+        return cls(
+            id=int(user["id"]),
+            username=user.get("username") or NOT_SPECIFIED,
+            first_name=user.get("first_name") or NOT_SPECIFIED,
+            joined=kiev_time_to_epoch(user.get("join_date")),
+            rating=record_rating(user.get("rating")),
+        )
+
+    @property
+    def join_date(self):
+        return epoch_to_kiev_time(self.joined)
+
+@dataclass(slots=True)
+class MuteRecord:
+    """Запис з muted_users: until - кінець муту в секундах епохи, None - безстроково"""
+    until: int | None
+    reason: str | None
+
+    @classmethod
+    def from_json(cls, info):
+        return cls(until=kiev_time_to_epoch(info.get("expiration")), reason=shared_text(info.get("reason")))
+
+    @property
+    def expiration(self):
+        return epoch_to_kiev_time(self.until)
+
+    def is_active(self, now=None):
+        return self.until is None or self.until > (now if now is not None else time.time())
+
+    def to_json(self):
+        return {"expiration": self.expiration, "reason": self.reason}
+
+@dataclass(slots=True)
+class BanRecord:
+    """Запис з banned_users: дата бану - секунди епохи"""
+    reason: str | None
+    banned_at: int | None
+
+    @classmethod
+    def from_json(cls, info):
+        return cls(reason=shared_text(info.get("reason")), banned_at=kiev_time_to_epoch(info.get("date")))
+
+    @property
+    def date(self):
+        return epoch_to_kiev_time(self.banned_at)
+
+    def to_json(self):
+        return {"reason": self.reason, "date": self.date}
+
+# ПРЕДСТАВЛЕННЯ МОДЕРАЦІЇ
+def build_moderation_views(data):
+    """Побудова представлень active/muted/banned: banned_users має пріоритет над muted_users"""
+    banned = {str(user_id): BanRecord.from_json(info) for user_id, info in data.get("banned_users", {}).items()}
+    muted = {}
+    for user_id, info in data.get("muted_users", {}).items():
+        user_id = str(user_id)
+        if user_id not in banned:
+            muted[user_id] = MuteRecord.from_json(info)
+    active = {user["id"] for user in data.get("users", [])} - banned.keys() - muted.keys()
+    return {"active": active, "muted": muted, "banned": banned}
+
+def get_moderation_views():
+    """Представлення модерації (будуються при першому зверненні та після імпорту)"""
+    if moderation_views.get("active") is None:
+        moderation_views.update(build_moderation_views(safe_json_read(DATA_FILE)))
+        STATS["muted"] = len(moderation_views["muted"])
+        STATS["banned"] = len(moderation_views["banned"])
+    return moderation_views
+
+def reset_moderation_views():
+    """Скидання представлень модерації, наступне звернення перебудує їх з файлу"""
+    moderation_views.clear()
+
+def set_moderation_status(user_id, status, info=None):
+    """Переведення користувача в одне з представлень: "active", "muted" або "banned" """
+    views = get_moderation_views()
+    previous = "banned" if user_id in views["banned"] else "muted" if user_id in views["muted"] else None
+
+    views["active"].discard(user_id)
+    views["muted"].pop(user_id, None)
+    views["banned"].pop(user_id, None)
+
+    if status == "active":
+        views["active"].add(user_id)
+    elif status == "muted":
+        views["muted"][user_id] = MuteRecord.from_json(info)
+    elif status == "banned":
+        views["banned"][user_id] = BanRecord.from_json(info)
+
+    if previous != status:
+        if previous:
+            stats_bump(previous, -1)
+        if status in ("muted", "banned"):
+            stats_bump(status)
+    invalidate_list_indexes()
+
+def save_moderation_changes(data, changes):
+    """Збереження даних і застосування змін до представлень лише після успішного запису.
+    Стан у чаті ("enforced") тут не змінюється - його позначає mark_enforced після успішного виклику Telegram"""
+    if not safe_json_write(data, DATA_FILE):
+        return False
+    for user_id, status, info in changes:
+        set_moderation_status(user_id, status, info)
+    return True
+
+def is_user_restricted(user_id):
+    """Чи заборонено користувачу писати боту: бан або мут, що ще не закінчився (мут без дати - безстроковий)"""
+    views = get_moderation_views()
+    if user_id in views["banned"]:
+        return True
+    mute_info = views["muted"].get(user_id)
+    return mute_info is not None and mute_info.is_active()
+
+def register_new_user(new_user):
+    """Оновлення лічильників, пошукового індексу та представлень після додавання користувача"""
+    stats_bump("users")
+    search_index_update(new_user["id"], new_user["username"], new_user["first_name"])
+    set_moderation_status(new_user["id"], "active")
+
+# РОЛІ
+ROLE_SECTIONS = {"admin": "admins", "programmer": "programmers"}
+
+def build_role_table(data):
+    """Таблиця ролей: юзернейм зі списків ролей -> множина ролей, а також прив'язки юзернейм <-> ID власника.
+    Прив'язки зберігаються в data["role_ids"]; юзернейм без прив'язки отримує власника при першій перевірці"""
+    by_username = {}
+    for role, section in ROLE_SECTIONS.items():
+        for username in data.get(section, []):
+            by_username.setdefault(username, set()).add(role)
+    owner = {username: str(user_id) for username, user_id in data.get("role_ids", {}).items()
+             if username in by_username}
+    return {"by_username": by_username, "owner": owner, "by_id": {user_id: username for username, user_id in owner.items()}}
+
+def get_role_table():
+    """Таблиця ролей (будується з файлу при першому зверненні, далі оновлюється командами та імпортом)"""
+    if not role_table:
+        role_table.update(build_role_table(safe_json_read(DATA_FILE)))
+    return role_table
+
+def bind_role_holder(username, user_id):
+    """Прив'язка юзернейму зі списків ролей до ID; у файл потрапляє з flush_pending_changes"""
+    table = get_role_table()
+    table["owner"][username] = user_id
+    table["by_id"][user_id] = username
+    role_state["dirty"] = True
+
+def unbind_role_holder(username):
+    """Зняття прив'язки, коли в юзернейму не залишилось ролей"""
+    table = get_role_table()
+    user_id = table["owner"].pop(username, None)
+    if user_id is not None:
+        table["by_id"].pop(user_id, None)
+        role_state["dirty"] = True
+
+def reload_role_table(data):
+    """Перебудова таблиці ролей з уже прочитаних даних (після імпорту); ще не збережені прив'язки не губляться"""
+    previous_owner = role_table.get("owner", {})
+    role_table.clear()
+    role_table.update(build_role_table(data))
+    for username, user_id in previous_owner.items():
+        if username in role_table["by_username"] and username not in role_table["owner"] \
+                and user_id not in role_table["by_id"]:
+            bind_role_holder(username, user_id)
+
+def set_user_role(username, role, granted):
+    """Видача або зняття ролі після успішного запису у файл (/admin, /deleteadmin, /programier, /deleteprogramier)"""
+    by_username = get_role_table()["by_username"]
+    roles = by_username.setdefault(username, set())
+    if granted:
+        roles.add(role)
+    else:
+        roles.discard(role)
+        if not roles:
+            del by_username[username]
+            unbind_role_holder(username)
+    invalidate_list_indexes()
+
+def rename_role_holder(user_id, new_username):
+    """Перенесення ролей на новий юзернейм, коли власник прив'язки змінив його.
+    Списки ролей у файлі оновлюються разом із профілями у flush_pending_changes"""
+    table = get_role_table()
+    old_username = table["by_id"].get(user_id)
+    if old_username is None or old_username == new_username:
+        return
+    other_owner = table["owner"].get(new_username)
+    if other_owner is not None and other_owner != user_id:
+        return  # Новий юзернейм уже прив'язаний до іншого ID - ролі не зливаються
+
+    roles = table["by_username"].pop(old_username, set())
+    table["by_username"].setdefault(new_username, set()).update(roles)
+    del table["owner"][old_username]
+    bind_role_holder(new_username, user_id)
+    role_renames[old_username] = new_username
+
+def user_roles(user):
+    """Ролі користувача Telegram за стабільним ID. За юзернеймом ролі видаються лише тоді, коли цей юзернейм
+    ще не прив'язаний до жодного ID - тоді ID прив'язується до нього. Без читання файлу"""
+    table = get_role_table()
+    user_id = str(user.id)
+    username = table["by_id"].get(user_id)
+    if username is not None:
+        return table["by_username"].get(username, set())
+
+    if user.username in table["by_username"] and user.username not in table["owner"]:
+        bind_role_holder(user.username, user_id)
+        return table["by_username"][user.username]
+    return set()
+
+def is_programmer(user):
+    """Перевірка, чи є користувач Telegram програмістом"""
+    return "programmer" in user_roles(user)
+
+def is_admin(user):
+    """Перевірка, чи є користувач Telegram адміністратором"""
+    return "admin" in user_roles(user)
 
 
 # КОНСТАНТИ ТА НАЛАШТУВАННЯ
 DATA_FILE = "data.json"
+STATS_FILE = "stats.json"  # Лічильники статистики: часті дрібні записи не переписують data.json
+LAST_SEEN_FILE = "last_seen.json"  # user_id -> час останньої активності, з тієї ж причини
+REPORT_WATERMARK_FILE = "report_watermark.json"  # Знімок стану після нічного звіту, з ним порівнюється наступний
+data_version = 0  # Збільшується після кожного запису DATA_FILE, використовується для інвалідації кешів
 application = None
-app = Flask(__name__)
-CREATOR_CHAT_ID = load_chat_id_from_file()  # ID чату для адміністраторів
-ALLUSERS_TEM_ID=load_allusers_tem_id_from_file()
-CAVE_CHAT_ID= load_cave_chat_id_from_file()
-
-
-BOTTOCEN = load_bottocen_from_file()
+startup_data = safe_json_read(DATA_FILE)  # Усі налаштування читаються з одного розбору файлу
+CREATOR_CHAT_ID = load_chat_id_from_file(startup_data)  # ID чату для адміністраторів
+ALLUSERS_TEM_ID=load_allusers_tem_id_from_file(startup_data)
+CAVE_CHAT_ID= load_cave_chat_id_from_file(startup_data)
+ACK_MODE = load_ack_mode_from_file(startup_data)
+STATS = load_stats_from_file(startup_data)
+stats_state = {"dirty": False}
+last_seen_times = load_last_seen_from_file(startup_data)
+seen_state = {"dirty": False, "flushed_at": 0.0}
+moderation_views = {}  # "active": set(user_id), "muted": {user_id: MuteRecord}, "banned": {user_id: BanRecord}
+role_table = {}  # "by_username": {юзернейм: set(роль)}, "owner": {юзернейм: user_id}, "by_id": {user_id: юзернейм}
+role_renames = {}  # старий юзернейм -> новий, ще не збережені у списках ролей
+role_state = {"dirty": False}  # Прив'язки ролей до ID змінилися і ще не збережені в data["role_ids"]
+
+EXCEL_TIMEOUT = 120  # Максимальний час (сек) на експорт або імпорт Excel
+EXCEL_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="excel")
+PARQUET_AVAILABLE = importlib.util.find_spec("pyarrow") is not None  # Parquet - лише якщо встановлено pyarrow
+EXPORT_CACHE_SIZE = 3  # Скільки останніх звітів тримати в пам'яті
+export_cache = {}  # (data_version, формат, фільтри): {"content", "filename", "file_id"} - у порядку створення
+export_inflight = {}  # (data_version, формат, фільтри): asyncio.Task побудови звіту
+IMPORT_ERRORS_SHOWN = 10  # Скільки помилок рядків показувати у звіті імпорту
+
+# Реакції для підтвердження доставки (✅/❌ не входять до списку дозволених реакцій Telegram)
+ACK_REACTION_OK = "👍"
+ACK_REACTION_FAIL = "👎"
+ACK_REACTION_DUPLICATE = "👀"  # Повтор уже надісланого повідомлення, повторно не пересилається
+reactions_unavailable_chats = set()
+
+COALESCE_WINDOW = load_coalesce_window_from_file(startup_data)
+MAX_MESSAGE_LENGTH = 4096
+coalesced_posts = {}  # user_id -> останній пост у темі, який ще можна доповнити
+
+RATE_LIMIT = load_rate_limit_from_file(startup_data)
+rate_buckets = {}  # user_id -> стан token bucket
+
+DEDUP = load_dedup_settings_from_file(startup_data)
+RECONCILE = load_reconcile_settings_from_file(startup_data)
+REPORTS = load_report_settings_from_file(startup_data)
+dedup_user_recent = {}  # user_id -> deque[(час, ключ)]
+dedup_global_recent = deque()  # (час, ключ, simhash, user_id)
+dedup_global_keys = {}  # ключ -> Counter(user_id)
+dedup_global_bands = {}  # (номер смуги, значення) -> Counter((simhash, user_id)) для пошуку схожих текстів
+dedup_suppressed = Counter()  # user_id -> кількість придушених повідомлень
+
+PROFILE_CACHE_TTL = 3600  # Скільки секунд профіль користувача вважається актуальним
+PROFILE_FETCH_CONCURRENCY = 10
+profile_cache = {}  # user_id -> (first_name, username, час отримання)
+
+LIST_PAGE_SIZE = 10
+LIST_SORT_KEYS = {
+    "join": "датою заходу",
+    "rating": "оцінкою",
+    "username": "юзернеймом",
+    "mute": "закінченням муту",
+}
+list_indexes = {}
+
+PROFILE_SEEN_FLUSH_INTERVAL = 300  # Як часто (сек) зберігати LAST_SEEN_FILE
+profile_directory = {}  # user_id -> {"username", "first_name", "full_name"}
+profile_dirty = set()  # user_id, чиї username/first_name ще не звірено з users[]
+
+FIND_RESULTS_LIMIT = 10
+search_index = {"built": False, "trie": {}, "trigrams": {}, "terms": {}}
+command_sync_task = None  # Фонове завантаження списків команд при запуску
+
+
+BOTTOCEN = load_bottocen_from_file(startup_data)
+del startup_data  # Не тримати копію всіх даних у пам'яті
 
-@app.route("/")
 def index():
     return "@Supp0rtsBot2"
 
 def run_flask():
+    from flask import Flask
+    app = Flask(__name__)
+    app.add_url_rule("/", "index", index)
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
 
 # ФУНКЦІЇ ДЛЯ РОБОТИ З EXCEL
-async def export_to_excel():
-    """Експорт даних у Excel файл з покращеною обробкою помилок та кольоровим форматуванням"""
+def check_excel_cancelled(cancel_event):
+    """Перервати фонову операцію з Excel, якщо її скасовано (наприклад, через тайм-аут)"""
+    if cancel_event is not None and cancel_event.is_set():
+        raise CancelledError("Операцію з Excel скасовано")
+
+async def run_excel_job(func, *args):
+    """Виконання важкої роботи з pandas/openpyxl у пулі потоків з тайм-аутом і скасуванням"""
+    cancel_event = threading.Event()
+    loop = asyncio.get_running_loop()
+    job = loop.run_in_executor(EXCEL_EXECUTOR, func, *args, cancel_event)
     try:
-        data = safe_json_read(DATA_FILE)
-        current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        excel_filename = f"SupportBot_{current_time}.xlsx"
-
-        # Create DataFrame and ensure unique index
-        all_users_df = pd.DataFrame(data["users"]).reset_index(drop=True)
-
-        # Check for duplicate user IDs
-        if all_users_df['id'].duplicated().any():
-            logging.warning("Duplicate user IDs found in data. Keeping first occurrence.")
-            all_users_df = all_users_df.drop_duplicates(subset='id', keep='first')
-
-        banned_ids = set(str(uid) for uid in data["banned_users"].keys())
-        muted_ids = set(str(mut) for mut in data["muted_users"].keys())
+        return await asyncio.wait_for(job, timeout=EXCEL_TIMEOUT)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        cancel_event.set()
+        raise
+
+def excel_column_widths(df):
+    """Ширини колонок аркуша за максимальною довжиною значень у DataFrame (з урахуванням заголовка)"""
+    from openpyxl.utils import get_column_letter
+    widths = {}
+    for col_idx, column in enumerate(df.columns, start=1):
+        max_length = len(str(column))
+        if len(df):
+            max_length = max(max_length, int(df[column].astype(str).str.len().max()))
+        widths[get_column_letter(col_idx)] = (max_length + 2) if max_length < 30 else 30
+    return widths
+
+def user_row_categories(df, banned_ids, muted_ids, admin_usernames, programmer_usernames, all_banned=False):
+    """Категорія кольору для кожного рядка аркуша користувачів.
+    Пріоритет: забанений > програміст > адмін > замучений; None - без кольору"""
+    categories = pd.Series([None] * len(df), index=df.index, dtype=object)
+    if df.empty:
+        return categories.tolist()
+
+    ids = df["id"].fillna("").astype(str)
+    usernames = df["username"].fillna("").astype(str).str.lstrip("@") if "username" in df.columns \
+        else pd.Series([""] * len(df), index=df.index)
+
+    # Присвоюємо від найнижчого пріоритету до найвищого, щоб старші категорії перезаписували молодші
+    categories[ids.isin(muted_ids)] = "muted"
+    categories[usernames.isin(admin_usernames)] = "admin"
+    categories[usernames.isin(programmer_usernames)] = "programmer"
+    categories[ids.isin(banned_ids) | all_banned] = "banned"
+    categories[ids == ""] = None
+    return categories.tolist()
+
+def format_export_dates(series):
+    """Переформатування дат "%H:%M %d/%m/%Y" у "%H:%M; %d/%m/%Y" для всієї колонки одразу.
+    Порожні значення та "Назавжди..." лишаються як є, нерозпізнані - "Невірний формат" """
+    text = series.astype(str)
+    keep = series.isna() | (text == "") | text.str.contains("Назавжди", regex=False)
+    cleaned = text.str.replace(";", "", regex=False).str.strip().str.replace(r"\s+", " ", regex=True)
+    parsed = pd.to_datetime(cleaned.where(~keep), format="%H:%M %d/%m/%Y", errors="coerce")
+    result = parsed.dt.strftime("%H:%M; %d/%m/%Y").astype(object)
+
+    # Дати поза діапазоном pandas (наприклад, мут до 2659 року) розбираємо звичайним strptime
+    for idx in result.index[parsed.isna() & ~keep]:
+        try:
+            result[idx] = datetime.strptime(cleaned[idx], "%H:%M %d/%m/%Y").strftime("%H:%M; %d/%m/%Y")
+        except ValueError as e:
+            logging.error(f"Помилка формату дати '{series[idx]}': {str(e)}")
+            result[idx] = "Невірний формат"
+
+    return result.where(~keep, series)
+
+def prepare_export_frames(data, views):
+    """Підготовка DataFrame для аркушів користувачів через об'єднання таблиць, без пошуку по рядках"""
+    all_users_df = pd.DataFrame(data["users"]).reset_index(drop=True)
+    if "id" not in all_users_df.columns:
+        all_users_df["id"] = pd.Series(dtype=object)
+    for column in ["username", "first_name", "join_date", "rating"]:
+        if column not in all_users_df.columns:
+            all_users_df[column] = None
+
+    # Check for duplicate user IDs
+    if all_users_df['id'].duplicated().any():
+        logging.warning("Duplicate user IDs found in data. Keeping first occurrence.")
+        all_users_df = all_users_df.drop_duplicates(subset='id', keep='first')
+
+    banned_ids = set(views["banned"])
+    muted_ids = set(views["muted"])
+
+    # Поля муту в users[] можуть бути як "mute", так і "mute/ban" (після імпорту) - замінюємо їх даними представлень
+    all_users_df = all_users_df.drop(columns=['mute', 'mute_end', 'mute/ban', 'mute/ban_end', 'reason'],
+                                     errors='ignore').reset_index(drop=True)
+    all_users_df['id'] = all_users_df['id'].astype(str)
+
+    muted_info = pd.DataFrame({"expiration": [info.expiration for info in views["muted"].values()],
+                               "reason": [info.reason for info in views["muted"].values()]},
+                              index=list(views["muted"]), columns=["expiration", "reason"])
+    banned_info = pd.DataFrame({"reason": [info.reason for info in views["banned"].values()]},
+                               index=list(views["banned"]), columns=["reason"])
+
+    # Стан модерації береться з представлень, а не з полів users[]
+    is_banned = all_users_df["id"].isin(banned_ids)
+    mute_end = all_users_df["id"].map(muted_info["expiration"]).astype(object)
+    reason = all_users_df["id"].map(banned_info["reason"])
+    reason = reason.where(reason.notna() & (reason != ""), all_users_df["id"].map(muted_info["reason"]))
+
+    all_users_df.insert(5, "mute/ban", all_users_df["id"].isin(muted_ids | banned_ids))
+    all_users_df.insert(6, "mute/ban_end", mute_end.where(~is_banned, "Назавжди (бан)"))
+    all_users_df.insert(7, "reason", reason)
+
+    users_df = all_users_df[~all_users_df["mute/ban"]].copy()
+    muted_df = all_users_df[all_users_df['id'].isin(muted_ids)].copy()
+
+    banned_columns = ["id", "username", "first_name", "join_date", "rating", "mute/ban", "mute/ban_end", "reason"]
+    banned_df = pd.DataFrame({
+        "id": [str(user_id) for user_id in views["banned"]],
+        "reason": [info.reason if info.reason is not None else "Забанений" for info in views["banned"].values()]
+    }).merge(all_users_df[["id", "username", "first_name", "join_date", "rating"]].astype(object), on="id", how="left")
+    for column, default in [("username", "Невідомо"), ("first_name", "Невідомо"), ("join_date", ""), ("rating", 0)]:
+        banned_df[column] = banned_df[column].where(banned_df[column].notna(), default)
+    banned_df["mute/ban"] = True
+    banned_df["mute/ban_end"] = "Назавжди (бан)"
+    banned_df = banned_df[banned_columns]
+
+    date_columns = ["mute/ban_end", "join_date"]
+    for df in [all_users_df, users_df, muted_df, banned_df]:
+        for col in date_columns:
+            df[col] = format_export_dates(df[col])
+
+    return {
+        "all_users": all_users_df,
+        "users": users_df,
+        "muted": muted_df,
+        "banned": banned_df,
+    }
 
-        admin_usernames = set(data.get("admins", []))
-        programmer_usernames = set(data.get("programmers", []))
+def excel_cell_value(value):
+    """Значення для комірки: NaN/None з DataFrame записуються як порожня комірка"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return value
+
+def stream_column_widths(columns, rows):
+    """Ширини колонок для потокового аркуша - один прохід по ітератору рядків без збереження даних"""
+    from openpyxl.utils import get_column_letter
+    lengths = [len(str(column)) for column in columns]
+    for row in rows:
+        for col_idx, value in enumerate(row):
+            length = len(str(value))
+            if length > lengths[col_idx]:
+                lengths[col_idx] = length
+    return {get_column_letter(col_idx): (length + 2) if length < 30 else 30
+            for col_idx, length in enumerate(lengths, start=1)}
+
+def write_excel_sheet(workbook, sheet_name, columns, rows, widths, row_fills=None, cancel_event=None):
+    """Потоковий запис аркуша у write-only книгу; стилі задаються одразу під час запису рядків"""
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Border, Side, Font
+    sheet = workbook.create_sheet(sheet_name)
+    for column_letter, width in widths.items():
+        sheet.column_dimensions[column_letter].width = width
+
+    # Стиль заголовків - такий самий, як ставив pandas.to_excel
+    header_font = Font(bold=True)
+    header_border = Border(left=Side(style="thin"), right=Side(style="thin"),
+                           top=Side(style="thin"), bottom=Side(style="thin"))
+    header_alignment = Alignment(horizontal="center", vertical="top")
+    header = []
+    for column in columns:
+        cell = WriteOnlyCell(sheet, value=column)
+        cell.font = header_font
+        cell.border = header_border
+        cell.alignment = header_alignment
+        header.append(cell)
+    sheet.append(header)
+
+    fills = iter(row_fills) if row_fills is not None else None
+    for row_number, row in enumerate(rows):
+        if row_number % 10000 == 0:
+            check_excel_cancelled(cancel_event)
+        fill_color = next(fills) if fills is not None else None
+        if fill_color is None:
+            sheet.append([excel_cell_value(value) for value in row])
+            continue
+        cells = []
+        for value in row:
+            cell = WriteOnlyCell(sheet, value=excel_cell_value(value))
+            cell.fill = fill_color
+            cells.append(cell)
+        sheet.append(cells)
+
+def export_sheet_specs(data, views, sheets=None):
+    """Аркуші експорту, спільні для всіх форматів: (назва, колонки, джерело рядків, DataFrame або None).
+    Джерела - функції, бо аркуш може проходитись двічі: для ширин колонок і для запису.
+    sheets - множина назв аркушів для вибіркового експорту (None - усі)"""
+    frames = prepare_export_frames(data, views)
+    specs = [
+        (sheet_name, list(frames[key].columns),
+         lambda df=frames[key]: df.itertuples(index=False, name=None), frames[key])
+        for sheet_name, key in [("AllUsers", "all_users"), ("ActiveUsers", "users"),
+                                ("MutedUsers", "muted"), ("BannedUsers", "banned")]
+    ]
 
-        all_users_df = all_users_df.rename(columns={
-            'mute': 'mute/ban',
-            'mute_end': 'mute/ban_end'
-        })
+    topics = data.get("topics", {})
+    user_topics = data.get("user_topics", {})
+    sent_messages = data.get("sent_messages", {})
+    general_info = [(
+        data.get("bot_token", ""),
+        data.get("owner_id", ""),
+        data.get("chat_id", ""),
+        data.get("cave_chat_id", "-1002648725095"),
+        data.get("allusers_tem_id", 386),
+        data.get("total_score", 0),
+        data.get("num_of_ratings", 0)
+    )]
+    # Великі аркуші читаються прямо зі словників сховища, без DataFrame
+    specs += [
+        ("Topics", ["user_id", "topic_id"], lambda: topics.items(), None),
+        ("UserTopics", ["topic_id", "user_id"], lambda: user_topics.items(), None),
+        ("SentMessages", ["message_id", "user_id"],
+         lambda: ((str(k), str(v)) for k, v in sent_messages.items()), None),
+        ("Admins", ["Admins"], lambda: ((admin,) for admin in data.get("admins", [])), None),
+        ("Programmers", ["Programmers"], lambda: ((programmer,) for programmer in data.get("programmers", [])), None),
+        ("GeneralInfo", ["bot_token", "owner_id", "chat_id", "cave_chat_id", "allusers_tem_id",
+                         "total_score", "num_of_ratings"], lambda: general_info, None),
+    ]
+    return [spec for spec in specs if sheets is None or spec[0] in sheets]
+
+def build_excel_report(data, views, sheets=None, cancel_event=None):
+    """Побудова Excel файлу з кольоровим форматуванням (виконується поза циклом подій); повертає вміст файлу.
+    Книга пишеться у write-only режимі: рядки не накопичуються в пам'яті"""
+    from openpyxl import Workbook
+    from openpyxl.styles import PatternFill
+    specs = export_sheet_specs(data, views, sheets)
+    check_excel_cancelled(cancel_event)
+
+    banned_ids = set(views["banned"])
+    muted_ids = set(views["muted"])
+    admin_usernames = set(data.get("admins", []))
+    programmer_usernames = set(data.get("programmers", []))
+
+    fills = {
+        "admin": PatternFill(start_color='ADD8E6', end_color='ADD8E6', fill_type='solid'),  # Адміни
+        "programmer": PatternFill(start_color='90EE90', end_color='90EE90', fill_type='solid'),  # Програмісти
+        "muted": PatternFill(start_color='FFA500', end_color='FFA500', fill_type='solid'),  # Замучені
+        "banned": PatternFill(start_color='FF6347', end_color='FF6347', fill_type='solid'),  # Забанені
+    }
 
-        all_users_df['id'] = all_users_df['id'].astype(str)
+    workbook = Workbook(write_only=True)
+    for sheet_name, columns, rows, df in specs:
+        check_excel_cancelled(cancel_event)
+        if df is None:
+            write_excel_sheet(workbook, sheet_name, columns, rows(), stream_column_widths(columns, rows()),
+                              cancel_event=cancel_event)
+            continue
 
-        # Add reason from banned_users or muted_users
-        all_users_df["reason"] = all_users_df["id"].apply(
-            lambda uid: data["banned_users"].get(uid, {}).get("reason") or
-                        data["muted_users"].get(uid, {}).get("reason")
+        categories = user_row_categories(
+            df, banned_ids, muted_ids, admin_usernames, programmer_usernames,
+            all_banned=(sheet_name == "BannedUsers")
+        )
+        write_excel_sheet(
+            workbook, sheet_name, columns, rows(), excel_column_widths(df),
+            row_fills=[fills[category] if category else None for category in categories],
+            cancel_event=cancel_event
         )
 
-        for user_id in banned_ids:
-            mask = all_users_df['id'] == user_id
-            all_users_df.loc[mask, 'mute/ban'] = True
-            all_users_df.loc[mask, 'mute/ban_end'] = "Назавжди (бан)"
-
-        # Reset index before filtering to ensure unique labels
-        all_users_df = all_users_df.reset_index(drop=True)
-
-        # Now the filtering should work without reindex errors
-        users_df = all_users_df[all_users_df["mute/ban"] == False].copy()
-        muted_df = all_users_df[(all_users_df["mute/ban"] == True) & (~all_users_df['id'].isin(banned_ids))].copy()
-
-        # Rest of your function remains the same...
-        banned_columns = ["id", "username", "first_name", "join_date", "rating", "mute/ban", "mute/ban_end", "reason"]
-        banned_data = []
-
-        for user_id, ban_info in data["banned_users"].items():
-            user_id = str(user_id)
-            user_data = all_users_df[all_users_df["id"] == user_id].iloc[0].to_dict() if not all_users_df[
-                all_users_df["id"] == user_id].empty else {
-                "username": "Невідомо",
-                "first_name": "Невідомо",
-                "join_date": "",
-                "rating": 0,
-                "mute/ban": True,
-                "mute/ban_end": "Назавжди (бан)",
-                "reason": ban_info.get("reason", "Забанений")
-            }
-            banned_data.append({
-                "id": user_id,
-                "username": user_data.get("username", "Невідомо"),
-                "first_name": user_data.get("first_name", "Невідомо"),
-                "join_date": user_data.get("join_date", ""),
-                "rating": user_data.get("rating", 0),
-                "mute/ban": True,
-                "mute/ban_end": "Назавжди (бан)",
-                "reason": ban_info.get("reason", "Забанений")
-            })
-
-        banned_df = pd.DataFrame(banned_data, columns=banned_columns)
-
-        topics_df = pd.DataFrame({
-            "user_id": list(data.get("topics", {}).keys()),
-            "topic_id": list(data.get("topics", {}).values())
-        })
-
-        user_topics_df = pd.DataFrame({
-            "topic_id": list(data.get("user_topics", {}).keys()),
-            "user_id": list(data.get("user_topics", {}).values())
-        })
-
-        sent_messages = {str(k): str(v) for k, v in data.get("sent_messages", {}).items()}
-        sent_messages_df = pd.DataFrame({
-            "message_id": list(sent_messages.keys()),
-            "user_id": list(sent_messages.values())
-        })
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+def plain_cell_value(value):
+    """Значення для CSV/JSON: NaN - None, числа numpy - звичайні числа Python"""
+    value = excel_cell_value(value)
+    return value.item() if hasattr(value, "item") else value
+
+def build_csv_bundle(data, views, sheets=None, cancel_event=None):
+    """Zip архів з окремим CSV для кожного аркуша; рядки пишуться потоком одразу у стиснений файл"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for sheet_name, columns, rows, df in export_sheet_specs(data, views, sheets):
+            check_excel_cancelled(cancel_event)
+            with io.TextIOWrapper(archive.open(f"{sheet_name}.csv", "w"), encoding="utf-8", newline="") as stream:
+                writer = csv.writer(stream)
+                writer.writerow(columns)
+                writer.writerows([plain_cell_value(value) for value in row] for row in rows())
+    return buffer.getvalue()
+
+def build_jsonl_export(data, views, sheets=None, cancel_event=None):
+    """JSON Lines у gzip: по запису на рядок, назва аркуша - у полі "sheet" """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb") as archive:
+        for sheet_name, columns, rows, df in export_sheet_specs(data, views, sheets):
+            check_excel_cancelled(cancel_event)
+            for row in rows():
+                record = {"sheet": sheet_name}
+                record.update(zip(columns, (plain_cell_value(value) for value in row)))
+                archive.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+    return buffer.getvalue()
+
+def build_parquet_bundle(data, views, sheets=None, cancel_event=None):
+    """Zip архів з окремим Parquet файлом для кожного аркуша (потрібен pyarrow)"""
+    buffer = io.BytesIO()
+    # Parquet уже стиснений, тому zip лише складає файли разом
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for sheet_name, columns, rows, df in export_sheet_specs(data, views, sheets):
+            check_excel_cancelled(cancel_event)
+            frame = df.copy() if df is not None else pd.DataFrame(list(rows()), columns=columns)
+            # У колонках з різнотипними значеннями (числа та рядки) pyarrow вимагає один тип
+            for column in frame.columns[frame.dtypes == object]:
+                frame[column] = frame[column].map(lambda value: None if excel_cell_value(value) is None else str(value))
+            archive.writestr(f"{sheet_name}.parquet", frame.to_parquet(index=False))
+    return buffer.getvalue()
+
+# Формат: (розширення файлу, функція побудови)
+EXPORT_FORMATS = {
+    "xlsx": (".xlsx", build_excel_report),
+    "csv": (".csv.zip", build_csv_bundle),
+    "jsonl": (".jsonl.gz", build_jsonl_export),
+    "parquet": (".parquet.zip", build_parquet_bundle),
+}
+
+def parse_export_format(value):
+    """Назва формату з аргументу команди: "csv", "csv.zip", "format=jsonl.gz"... (None, якщо невідомий)"""
+    fmt = value.lower().removeprefix("format=").split(".")[0]
+    return fmt if fmt in EXPORT_FORMATS else None
+
+# Групи аркушів для аргументу sheets= у /get_alllist
+EXPORT_SHEET_GROUPS = {
+    "users": ["AllUsers"],
+    "active": ["ActiveUsers"],
+    "muted": ["MutedUsers"],
+    "banned": ["BannedUsers"],
+    "topics": ["Topics", "UserTopics"],
+    "messages": ["SentMessages"],
+    "roles": ["Admins", "Programmers"],
+    "general": ["GeneralInfo"],
+}
+
+def parse_export_args(args):
+    """Розбір аргументів /get_alllist: формат і фільтри status=, since=, rating<N, sheets=.
+    Повертає (формат, фільтри); при помилці - ValueError з поясненням"""
+    fmt = "xlsx"
+    filters = {}
+    for arg in args:
+        match = re.fullmatch(r"(\w+)\s*(<=|>=|=|<|>)\s*(.+)", arg)
+        if not match:
+            fmt = parse_export_format(arg)
+            if fmt is None:
+                raise ValueError(f"Невідомий формат або аргумент: {arg}")
+            continue
 
-        def safe_date_parse(date_str):
+        name, op, value = match.group(1).lower(), match.group(2), match.group(3).lower()
+        if name != "rating" and op != "=":
+            raise ValueError(f"Для {name} підтримується лише '='")
+
+        if name == "format":
+            fmt = parse_export_format(value)
+            if fmt is None:
+                raise ValueError(f"Невідомий формат: {value}")
+        elif name == "status":
+            statuses = set(value.split(","))
+            if not statuses <= {"active", "muted", "banned"}:
+                raise ValueError("status може бути active, muted або banned")
+            filters["status"] = statuses
+        elif name == "since":
+            period = re.fullmatch(r"(\d+)([dhm])", value)
+            if not period:
+                raise ValueError("since задається як 7d, 12h або 30m")
+            unit = {"d": "days", "h": "hours", "m": "minutes"}[period.group(2)]
+            filters["since"] = timedelta(**{unit: int(period.group(1))})
+        elif name == "rating":
             try:
-                if not date_str or "Назавжди" in str(date_str):
-                    return date_str
-                clean_str = date_str.replace(";", "").strip()
-                return datetime.strptime(clean_str, "%H:%M %d/%m/%Y").strftime("%H:%M; %d/%m/%Y")
-            except ValueError as e:
-                logging.error(f"Помилка формату дати '{date_str}': {str(e)}")
-                return "Невірний формат"
-
-        date_columns = ["mute/ban_end", "join_date"]
-        for df in [all_users_df, users_df, muted_df, banned_df]:
-            for col in date_columns:
-                if col in df.columns:
-                    df[col] = df[col].apply(safe_date_parse)
-
-        with pd.ExcelWriter(excel_filename, engine='openpyxl') as writer:
-            sheets = [
-                ("AllUsers", all_users_df),
-                ("ActiveUsers", users_df),
-                ("MutedUsers", muted_df),
-                ("BannedUsers", banned_df),
-                ("Topics", topics_df),
-                ("UserTopics", user_topics_df),
-                ("SentMessages", sent_messages_df),
-                ("Admins", pd.DataFrame(data.get("admins", []), columns=["Admins"])),
-                ("Programmers", pd.DataFrame(data.get("programmers", []), columns=["Programmers"])),
-                ("GeneralInfo", pd.DataFrame([{
-                    "bot_token": data.get("bot_token", ""),
-                    "owner_id": data.get("owner_id", ""),
-                    "chat_id": data.get("chat_id", ""),
-                    "cave_chat_id": data.get("cave_chat_id", "-1002648725095"),
-                    "allusers_tem_id": data.get("allusers_tem_id", 386),
-                    "total_score": data.get("total_score", 0),
-                    "num_of_ratings": data.get("num_of_ratings", 0)
-                }]))
-            ]
-
-            for sheet_name, df in sheets:
-                df.to_excel(writer, index=False, sheet_name=sheet_name)
-
-            workbook = writer.book
-
-            blue_fill = PatternFill(start_color='ADD8E6', end_color='ADD8E6', fill_type='solid')  # Адміни
-            green_fill = PatternFill(start_color='90EE90', end_color='90EE90', fill_type='solid')  # Програмісти
-            orange_fill = PatternFill(start_color='FFA500', end_color='FFA500', fill_type='solid')  # Замучені
-            red_fill = PatternFill(start_color='FF6347', end_color='FF6347', fill_type='solid')  # Забанені
-
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-
-                for column in sheet.columns:
-                    max_length = max(len(str(cell.value)) for cell in column)
-                    adjusted_width = (max_length + 2) if max_length < 30 else 30
-                    sheet.column_dimensions[column[0].column_letter].width = adjusted_width
-
-                if sheet_name not in ["AllUsers", "ActiveUsers", "MutedUsers", "BannedUsers"]:
-                    continue
-
-                max_row = sheet.max_row
-                max_col = sheet.max_column
-
-                for row in sheet.iter_rows(min_row=2, max_row=max_row, max_col=max_col):
-                    if not row[0].value:
-                        continue
-
-                    user_id = str(row[0].value)
-                    username_cell = None
-
-                    for cell in row:
-                        if cell.column_letter and sheet.cell(row=1, column=cell.col_idx).value == "username":
-                            username_cell = cell
-                            break
-
-                    username = username_cell.value if username_cell else None
-                    username = username.lstrip('@') if isinstance(username, str) and username.startswith(
-                        "@") else username
+                filters["rating"] = (op, float(value))
+            except ValueError:
+                raise ValueError("rating порівнюється з числом, наприклад rating<3")
+        elif name == "sheets":
+            groups = value.split(",")
+            unknown = [group for group in groups if group not in EXPORT_SHEET_GROUPS]
+            if unknown:
+                raise ValueError(f"Невідомі аркуші: {', '.join(unknown)}. Доступні: {', '.join(EXPORT_SHEET_GROUPS)}")
+            filters["sheets"] = {sheet for group in groups for sheet in EXPORT_SHEET_GROUPS[group]}
+        else:
+            raise ValueError(f"Невідомий фільтр: {name}")
+    return fmt, filters
+
+def export_filters_key(filters):
+    """Незмінний ключ фільтрів для кешу звітів (since - з точністю до хвилини)"""
+    key = []
+    for name, value in sorted(filters.items()):
+        if name == "since":
+            value = (datetime.now() - value).strftime("%Y-%m-%d %H:%M")
+        elif isinstance(value, set):
+            value = tuple(sorted(value))
+        key.append((name, value))
+    return tuple(key)
+
+def select_export_user_ids(filters):
+    """Ідентифікатори користувачів, що проходять фільтри (None - без фільтра за користувачами).
+    Статус береться з представлень модерації, дата заходу та оцінка - бінарним пошуком у відсортованих індексах"""
+    indexes = get_list_indexes()
+    users = indexes["users"]
+    selected = None
+
+    def narrow(user_ids):
+        nonlocal selected
+        selected = set(user_ids) if selected is None else selected & set(user_ids)
+
+    if "status" in filters:
+        views = get_moderation_views()
+        narrow(user_id for status in filters["status"] for user_id in views[status])
+
+    if "since" in filters:
+        by_join = indexes["all"]["join"]
+        start = bisect.bisect_left(by_join, (datetime.now() - filters["since"]).timestamp(),
+                                   key=lambda user_id: users[user_id].joined or 0)
+        narrow(by_join[start:])
+
+    if "rating" in filters:
+        # Індекс відсортований за спаданням оцінки (ключ -rating)
+        by_rating = indexes["all"]["rating"]
+        op, value = filters["rating"]
+        rating_key = lambda user_id: -users[user_id].rating
+        left = bisect.bisect_left(by_rating, -value, key=rating_key)
+        right = bisect.bisect_right(by_rating, -value, key=rating_key)
+        narrow({"<": by_rating[right:], "<=": by_rating[left:], ">": by_rating[:left],
+                ">=": by_rating[:right], "=": by_rating[left:right]}[op])
+
+    return selected
+
+def filter_export_data(data, views, user_ids):
+    """Дані та представлення лише для вибраних користувачів; DataFrame потім будуються з меншої вибірки"""
+    topics = data.get("topics", {})
+    selected_topics = {user_id: topics[user_id] for user_id in user_ids if user_id in topics}
+    filtered = dict(data)
+    filtered.update({
+        "users": [user for user in data.get("users", []) if user["id"] in user_ids],
+        "topics": selected_topics,
+        "user_topics": {str(topic_id): user_id for user_id, topic_id in selected_topics.items()},
+        "sent_messages": {message_id: user_id for message_id, user_id in data.get("sent_messages", {}).items()
+                          if str(user_id) in user_ids},
+    })
+    filtered_views = {
+        "muted": {user_id: info for user_id, info in views["muted"].items() if user_id in user_ids},
+        "banned": {user_id: info for user_id, info in views["banned"].items() if user_id in user_ids},
+    }
+    return filtered, filtered_views
+
+def detect_file_format(file_name):
+    """Формат файлу імпорту за розширенням (за замовчуванням xlsx)"""
+    name = (file_name or "").lower()
+    for fmt, (suffix, builder) in EXPORT_FORMATS.items():
+        if name.endswith(suffix):
+            return fmt
+    return "xlsx"
+
+async def export_report(fmt="xlsx", filters=None):
+    """Експорт даних у вибраному форматі (за замовчуванням Excel з кольоровим форматуванням); повертає вміст файлу.
+    Фільтри застосовуються до індексів ще до побудови DataFrame.
+    Сама побудова файлу виконується у фоновому потоці в пам'яті, бот у цей час продовжує відповідати"""
+    filters = filters or {}
+    try:
+        data = safe_json_read(DATA_FILE)
+        views = get_moderation_views()
+        views_snapshot = {"muted": dict(views["muted"]), "banned": dict(views["banned"])}
 
-                    fill_color = None
-                    if sheet_name == "BannedUsers" or user_id in banned_ids:
-                        fill_color = red_fill
-                    elif username in programmer_usernames:
-                        fill_color = green_fill
-                    elif username in admin_usernames:
-                        fill_color = blue_fill
-                    elif user_id in muted_ids:
-                        fill_color = orange_fill
+        for user in data.get("users", []):
+            if user["id"] in last_seen_times:
+                user["last_seen"] = last_seen_times[user["id"]]
 
-                    if fill_color:
-                        for cell in row:
-                            cell.fill = fill_color
+        user_ids = select_export_user_ids(filters)
+        if user_ids is not None:
+            data, views_snapshot = filter_export_data(data, views_snapshot, user_ids)
 
-        return excel_filename
+        return await run_excel_job(EXPORT_FORMATS[fmt][1], data, views_snapshot, filters.get("sheets"))
 
+    except asyncio.TimeoutError:
+        logging.error(f"Експорт не завершився за {EXCEL_TIMEOUT} с і був скасований")
+        return None
     except Exception as e:
         logging.error(f"Критична помилка при експорті: {str(e)}", exc_info=True)
         return None
 
-async def import_from_excel(file_path):
-    """Импорт данных из Excel: только забаненные из BannedUsers, заглушенные из MutedUsers"""
-    try:
-        data = safe_json_read(DATA_FILE)
-        new_data = {
-            "users": [],
-            "muted_users": {},
-            "banned_users": {},
-            "admins": data.get("admins", []),
-            "programmers": data.get("programmers", []),
-            "bot_token": data.get("bot_token", ""),
-            "owner_id": data.get("owner_id", ""),
-            "chat_id": data.get("chat_id", ""),
-            "cave_chat_id": data.get("cave_chat_id", "-1002648725095"),
-            "allusers_tem_id": data.get("allusers_tem_id", 386),
-            "total_score": data.get("total_score", 0),
-            "num_of_ratings": data.get("num_of_ratings", 0),
-            "sent_messages": {},
-            "topics": {},
-            "user_topics": {}
+async def build_export_entry(key, filters):
+    """Побудова звіту для (версія даних, формат, фільтри) і збереження його в кеші"""
+    version, fmt, filters_key = key
+    content = await export_report(fmt, filters)
+    if not content:
+        return None
+
+    current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    entry = {"content": content, "filename": f"SupportBot_{current_time}{EXPORT_FORMATS[fmt][0]}", "file_id": None}
+    export_cache[key] = entry
+    while len(export_cache) > EXPORT_CACHE_SIZE:
+        export_cache.pop(next(iter(export_cache)))
+    return entry
+
+async def get_cached_export(fmt="xlsx", filters=None):
+    """Звіт для поточного стану даних: з кешу, якщо дані не змінювались, інакше нова побудова.
+    Одночасні запити на ту саму версію, формат і фільтри чекають одну спільну побудову"""
+    filters = filters or {}
+    key = (data_version, fmt, export_filters_key(filters))
+    entry = export_cache.get(key)
+    if entry:
+        return entry
+
+    task = export_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(build_export_entry(key, filters))
+        export_inflight[key] = task
+        task.add_done_callback(lambda _: export_inflight.pop(key, None))
+    # shield - скасування одного з очікувачів не зупиняє побудову для решти
+    return await asyncio.shield(task)
+
+async def send_export(send_document, entry, **kwargs):
+    """Відправка звіту з кешу; повторно використовує file_id Telegram, якщо файл уже завантажувався"""
+    if entry["file_id"]:
+        try:
+            return await send_document(document=entry["file_id"], **kwargs)
+        except telegram.error.TelegramError as e:
+            logging.warning(f"Не вдалося надіслати звіт за file_id, завантажуємо повторно: {str(e)}")
+            entry["file_id"] = None
+
+    sent = await send_document(document=entry["content"], filename=entry["filename"], **kwargs)
+    if sent and sent.document:
+        entry["file_id"] = sent.document.file_id
+    return sent
+
+IMPORT_USER_FIELDS = ["username", "first_name", "join_date", "rating"]
+IMPORT_SECTION_TITLES = {
+    "users": "Користувачі",
+    "banned_users": "Забанені",
+    "muted_users": "Замучені",
+    "topics": "Теми",
+    "user_topics": "Теми користувачів",
+    "sent_messages": "Повідомлення",
+    "admins": "Адміни",
+    "programmers": "Програмісти",
+}
+
+def import_user_id(value):
+    """Ідентифікатор з комірки Excel у вигляді рядка (None, якщо це не ціле число)"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, float):
+        if not value.is_integer():
+            return None
+        value = int(value)
+    text = str(value).strip()
+    return text if re.fullmatch(r"-?\d+", text) else None
+
+def import_sheet_rows(rows):
+    """Потокове читання аркуша (перший рядок - заголовки): (номер рядка, {заголовок: значення})
+    для кожного непорожнього рядка; порожні рядки CSV вважаються відсутніми значеннями"""
+    rows = iter(rows)
+    headers = next(rows, None)
+    if not headers:
+        return
+    headers = [str(header).strip() if header is not None else "" for header in headers]
+    for row_number, row in enumerate(rows, start=2):
+        values = [None if value == "" else value for value in row] if row else []
+        if all(value is None for value in values):
+            continue
+        yield row_number, dict(zip(headers, values))
+
+def load_import_source(content, fmt):
+    """Аркуші файлу імпорту: ({назва: функція, що повертає (номер рядка, запис)}, функція закриття)"""
+    if fmt == "xlsx":
+        from openpyxl import load_workbook
+        wb = load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+        sheets = {name: (lambda ws=wb[name]: import_sheet_rows(ws.iter_rows(values_only=True)))
+                  for name in wb.sheetnames}
+        return sheets, wb.close
+
+    if fmt == "jsonl":
+        grouped = {}
+        with gzip.GzipFile(fileobj=io.BytesIO(content)) as stream:
+            for line in stream:
+                if line.strip():
+                    record = json.loads(line)
+                    grouped.setdefault(record.pop("sheet", ""), []).append(record)
+        sheets = {name: (lambda records=records: (
+            (row_number, {key: None if value == "" else value for key, value in record.items()})
+            for row_number, record in enumerate(records, start=2)
+        )) for name, records in grouped.items()}
+        return sheets, lambda: None
+
+    archive = zipfile.ZipFile(io.BytesIO(content))
+    suffix = ".csv" if fmt == "csv" else ".parquet"
+
+    def read_member(member):
+        if fmt == "csv":
+            with io.TextIOWrapper(archive.open(member), encoding="utf-8", newline="") as stream:
+                yield from import_sheet_rows(csv.reader(stream))
+        else:
+            frame = pd.read_parquet(io.BytesIO(archive.read(member)))
+            frame = frame.astype(object).where(frame.notna(), None)
+            yield from import_sheet_rows(itertools.chain([list(frame.columns)],
+                                                         frame.itertuples(index=False, name=None)))
+
+    sheets = {member[:-len(suffix)]: (lambda member=member: read_member(member))
+              for member in archive.namelist() if member.endswith(suffix)}
+    return sheets, archive.close
+
+def diff_import_section(current, incoming, changed_fields):
+    """Різниця між поточним і імпортованим словником {id: запис}: додані, змінені та відсутні у файлі"""
+    diff = {"added": {}, "changed": {}, "removed": [key for key in current if key not in incoming]}
+    for key, record in incoming.items():
+        if key not in current:
+            diff["added"][key] = record
+            continue
+        changes = changed_fields(current[key], record)
+        if changes:
+            diff["changed"][key] = changes
+    return diff
+
+def compare_record_fields(current, record):
+    """Поля запису, значення яких відрізняється від поточного"""
+    if not isinstance(current, dict):
+        return dict(record) if current != record else {}
+    return {field: value for field, value in record.items() if current.get(field) != value}
+
+def compare_plain_values(current, value):
+    """Для словників виду {id: id}: нове значення, якщо воно змінилось.
+    Порівнюються рядкові форми - 123 у файлі та "123" в імпорті вважаються однаковими"""
+    return {"value": value} if str(current) != str(value) else {}
+
+def parse_import_users(rows, errors):
+    """AllUsers: користувачі з перевіркою id, рейтингу та дати приєднання"""
+    incoming = {}
+    for row_number, row in rows:
+        user_id = import_user_id(row.get("id"))
+        if user_id is None:
+            errors.append(f"AllUsers:{row_number}: некоректний id {row.get('id')!r}")
+            continue
+        record = {}
+        for field in IMPORT_USER_FIELDS:
+            if field not in row:
+                continue
+            value = row[field]
+            if field == "rating" and value is not None:
+                # У CSV числа приходять рядками
+                try:
+                    if isinstance(value, bool):
+                        raise ValueError
+                    value = float(value)
+                except (TypeError, ValueError):
+                    errors.append(f"AllUsers:{row_number}: некоректний рейтинг {row[field]!r}")
+                    continue
+                value = int(value) if value.is_integer() else value
+            elif field == "join_date" and value is not None and parse_kiev_time(str(value)) is None:
+                errors.append(f"AllUsers:{row_number}: некоректна дата {value!r}")
+                continue
+            elif value is not None:
+                value = str(value)
+            record[field] = value
+        incoming[user_id] = record
+    return incoming
+
+def parse_import_banned(rows, errors):
+    """BannedUsers: причина бану для кожного id"""
+    incoming = {}
+    for row_number, row in rows:
+        user_id = import_user_id(row.get("id"))
+        if user_id is None:
+            errors.append(f"BannedUsers:{row_number}: некоректний id {row.get('id')!r}")
+            continue
+        reason = row.get("reason")
+        incoming[user_id] = {"reason": str(reason) if reason is not None else "Импортировано из файла"}
+    return incoming
+
+def parse_import_muted(rows, errors):
+    """MutedUsers: закінчення та причина муту; кінець муту - колонка "mute/ban_end" (або стара "mute_end")"""
+    incoming = {}
+    for row_number, row in rows:
+        user_id = import_user_id(row.get("id"))
+        if user_id is None:
+            errors.append(f"MutedUsers:{row_number}: некоректний id {row.get('id')!r}")
+            continue
+        expiration = row.get("mute/ban_end", row.get("mute_end"))
+        if expiration is not None and parse_kiev_time(str(expiration)) is None:
+            errors.append(f"MutedUsers:{row_number}: некоректна дата закінчення муту {expiration!r}")
+            continue
+        reason = row.get("reason")
+        incoming[user_id] = {
+            "expiration": str(expiration) if expiration is not None else None,
+            "reason": str(reason) if reason is not None else "Причина не указана"
         }
+    return incoming
+
+def parse_import_pairs(rows, sheet_name, key_column, value_column, errors, int_value=False):
+    """Двоколонкові аркуші (Topics, UserTopics, SentMessages) у словник {ключ: значення}"""
+    incoming = {}
+    for row_number, row in rows:
+        key = import_user_id(row.get(key_column))
+        value = import_user_id(row.get(value_column))
+        if key is None or value is None:
+            errors.append(f"{sheet_name}:{row_number}: некоректні значення {row.get(key_column)!r}, "
+                          f"{row.get(value_column)!r}")
+            continue
+        incoming[key] = int(value) if int_value else value
+    return incoming
 
-        wb = load_workbook(file_path)
-
-        # GeneralInfo
-        if "GeneralInfo" in wb.sheetnames:
-            ws = wb["GeneralInfo"]
-            headers = [cell.value for cell in ws[1]] if len(ws[1]) > 0 else []
-
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                if row and len(row) >= 7:
-                    if len(headers) >= 1 and row[0]:
-                        new_data["bot_token"] = str(row[0])
-                    if len(headers) >= 2 and row[1]:
-                        new_data["owner_id"] = str(row[1])
-                    if len(headers) >= 3 and row[2]:
-                        new_data["chat_id"] = str(row[2])
-                    if len(headers) >= 4 and row[3]:
-                        new_data["cave_chat_id"] = str(row[3])
-                    if len(headers) >= 5 and row[4] is not None:
-                        new_data["allusers_tem_id"] = int(row[4])
-                    if len(headers) >= 6 and row[5] is not None:
-                        new_data["total_score"] = float(row[5])
-                    if len(headers) >= 7 and row[6] is not None:
-                        new_data["num_of_ratings"] = int(row[6])
-
-        # BannedUsers
-        # Чтение BannedUsers
-        if "BannedUsers" in wb.sheetnames:
-            ws = wb["BannedUsers"]
-            headers = [cell.value for cell in ws[1]] if len(ws[1]) > 0 else []
-
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                if row and len(row) >= 1:
-                    user_id = str(row[0])
-                    reason = ""
-                    if "reason" in headers:
-                        reason_index = headers.index("reason")
-                        reason = row[reason_index] if reason_index < len(row) else "Импортировано из файла"
-                    else:
-                        reason = "Импортировано из файла"
-
-                    new_data["banned_users"][user_id] = {
-                        "reason": reason,
-                        "date": get_current_time_kiev()
-                    }
-
-        # Чтение MutedUsers
-        if "MutedUsers" in wb.sheetnames:
-            ws = wb["MutedUsers"]
-            headers = [cell.value for cell in ws[1]] if len(ws[1]) > 0 else []
-
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                if row and len(row) >= 1:
-                    user_id = str(row[0])
-                    reason = ""
-                    expiration = None
-
-                    if "reason" in headers:
-                        reason_index = headers.index("reason")
-                        reason = row[reason_index] if reason_index < len(row) else "Причина не указана"
-                    else:
-                        reason = "Причина не указана"
-
-                    if "mute_end" in headers:
-                        expiration_index = headers.index("mute_end")
-                        if expiration_index < len(row):
-                            expiration = row[expiration_index]
-
-                    new_data["muted_users"][user_id] = {
-                        "expiration": expiration,
-                        "reason": reason
-                    }
-
-        # Остальные листы (без изменений)
-        if "AllUsers" in wb.sheetnames:
-            ws = wb["AllUsers"]
-            headers = [cell.value for cell in ws[1]] if len(ws[1]) > 0 else []
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                if len(row) >= 7 and len(headers) >= 7:
-                    user_data = dict(zip(headers[:7], row[:7]))
-                    new_data["users"].append(user_data)
-
-        if "Topics" in wb.sheetnames:
-            ws = wb["Topics"]
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                if row and len(row) >= 2:
-                    new_data["topics"][str(row[0])] = row[1]
-
-        if "UserTopics" in wb.sheetnames:
-            ws = wb["UserTopics"]
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                if row and len(row) >= 2:
-                    new_data["user_topics"][str(row[0])] = str(row[1])
-
-        if "SentMessages" in wb.sheetnames:
-            ws = wb["SentMessages"]
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                if row and len(row) >= 2:
-                    new_data["sent_messages"][str(row[0])] = str(row[1])
-
-        if "Admins" in wb.sheetnames:
-            ws = wb["Admins"]
-            new_data["admins"] = [row[0] for row in ws.iter_rows(min_row=2, values_only=True) if row and row[0]]
-
-        if "Programmers" in wb.sheetnames:
-            ws = wb["Programmers"]
-            new_data["programmers"] = [row[0] for row in ws.iter_rows(min_row=2, values_only=True) if row and row[0]]
-
-        safe_json_write(new_data, DATA_FILE)
-        return True
+def parse_import_file(content, fmt, data, cancel_event=None):
+    """Потокове читання файлу імпорту (вмісту в пам'яті) з перевіркою рядків і розрахунком різниці
+    з поточними даними (виконується поза циклом подій). Повертає (різниця, помилки)"""
+    diff = {}
+    errors = []
 
+    sheets, close = load_import_source(content, fmt)
+    try:
+        check_excel_cancelled(cancel_event)
+
+        if "GeneralInfo" in sheets:
+            settings = {}
+            converters = {
+                "bot_token": str, "owner_id": str, "chat_id": str, "cave_chat_id": str,
+                "allusers_tem_id": int, "total_score": float, "num_of_ratings": int
+            }
+            for row_number, row in sheets["GeneralInfo"]():
+                for key, convert in converters.items():
+                    if row.get(key) in (None, ""):
+                        continue
+                    try:
+                        value = convert(row[key])
+                    except (TypeError, ValueError):
+                        errors.append(f"GeneralInfo:{row_number}: некоректне значення {key}={row[key]!r}")
+                        continue
+                    if data.get(key) != value:
+                        settings[key] = value
+                break
+            diff["settings"] = settings
+
+        if "AllUsers" in sheets:
+            check_excel_cancelled(cancel_event)
+            current = {str(user.get("id")): user for user in data.get("users", [])}
+            diff["users"] = diff_import_section(current, parse_import_users(sheets["AllUsers"](), errors),
+                                                compare_record_fields)
+
+        for sheet_name, section, parser in [("BannedUsers", "banned_users", parse_import_banned),
+                                            ("MutedUsers", "muted_users", parse_import_muted)]:
+            if sheet_name in sheets:
+                check_excel_cancelled(cancel_event)
+                diff[section] = diff_import_section(data.get(section, {}), parser(sheets[sheet_name](), errors),
+                                                    compare_record_fields)
+
+        for sheet_name, section, key_column, value_column, int_value in [
+            ("Topics", "topics", "user_id", "topic_id", True),
+            ("UserTopics", "user_topics", "topic_id", "user_id", False),
+            ("SentMessages", "sent_messages", "message_id", "user_id", False),
+        ]:
+            if sheet_name in sheets:
+                check_excel_cancelled(cancel_event)
+                incoming = parse_import_pairs(sheets[sheet_name](), sheet_name, key_column, value_column, errors,
+                                              int_value=int_value)
+                current = {str(key): value for key, value in data.get(section, {}).items()}
+                diff[section] = diff_import_section(current, incoming, compare_plain_values)
+
+        for sheet_name, section in [("Admins", "admins"), ("Programmers", "programmers")]:
+            if sheet_name in sheets:
+                values = (next(iter(row.values()), None) for row_number, row in sheets[sheet_name]())
+                incoming = [str(value) for value in values if value]
+                current = data.get(section, [])
+                diff[section] = {
+                    "added": [name for name in incoming if name not in current],
+                    "removed": [name for name in current if name not in incoming]
+                }
+    finally:
+        close()
+
+    return diff, errors
+
+def apply_import_diff(data, diff, prune=False):
+    """Застосування різниці імпорту до даних; записи, відсутні у файлі, видаляються лише з prune"""
+    data.update(diff.get("settings", {}))
+
+    if "users" in diff:
+        section = diff["users"]
+        users_by_id = {str(user.get("id")): user for user in data.setdefault("users", [])}
+        for user_id, changes in section["changed"].items():
+            if user_id in users_by_id:
+                users_by_id[user_id].update(changes)
+        for user_id, record in section["added"].items():
+            if user_id not in users_by_id:
+                data["users"].append({"id": user_id, **record})
+        if prune and section["removed"]:
+            removed = set(section["removed"])
+            data["users"] = [user for user in data["users"] if str(user.get("id")) not in removed]
+
+    if "banned_users" in diff:
+        section = diff["banned_users"]
+        banned = data.setdefault("banned_users", {})
+        for user_id, changes in section["changed"].items():
+            banned.setdefault(user_id, {}).update(changes)
+        for user_id, record in section["added"].items():
+            banned[user_id] = {**record, "date": get_current_time_kiev()}
+        if prune:
+            for user_id in section["removed"]:
+                banned.pop(user_id, None)
+
+    if "muted_users" in diff:
+        section = diff["muted_users"]
+        muted = data.setdefault("muted_users", {})
+        for user_id, changes in section["changed"].items():
+            muted.setdefault(user_id, {}).update(changes)
+        for user_id, record in section["added"].items():
+            muted[user_id] = record
+        if prune:
+            for user_id in section["removed"]:
+                muted.pop(user_id, None)
+
+    for section_name in ["topics", "user_topics", "sent_messages"]:
+        if section_name not in diff:
+            continue
+        section = diff[section_name]
+        target = data.setdefault(section_name, {})
+        for key, changes in section["changed"].items():
+            target[key] = changes["value"]
+        target.update(section["added"])
+        if prune:
+            for key in section["removed"]:
+                target.pop(key, None)
+
+    for section_name in ["admins", "programmers"]:
+        if section_name not in diff:
+            continue
+        names = data.setdefault(section_name, [])
+        names.extend(name for name in diff[section_name]["added"] if name not in names)
+        if prune:
+            data[section_name] = [name for name in names if name not in diff[section_name]["removed"]]
+
+    return data
+
+def format_import_diff(diff, errors, dry_run=False, prune=False):
+    """Текстовий звіт про різницю імпорту"""
+    lines = ["🔍 Перевірка файлу (зміни НЕ застосовано):" if dry_run else "✅ Дані імпортовано:"]
+    for section_name, title in IMPORT_SECTION_TITLES.items():
+        if section_name not in diff:
+            continue
+        section = diff[section_name]
+        changed = len(section.get("changed", {}))
+        lines.append(f"• {title}: +{len(section['added'])}, ~{changed}, −{len(section['removed'])}")
+    if diff.get("settings"):
+        lines.append(f"• Налаштування: {', '.join(diff['settings'])}")
+
+    removed_total = sum(len(section["removed"]) for name, section in diff.items() if name != "settings")
+    if removed_total and not prune:
+        lines.append(f"\nВідсутні у файлі записи ({removed_total}) не видаляються. "
+                     "Щоб видалити їх, використайте /set_alllist prune")
+
+    if errors:
+        lines.append(f"\n⚠️ Помилки у файлі (ці значення пропущено): {len(errors)}")
+        lines.extend(errors[:IMPORT_ERRORS_SHOWN])
+        if len(errors) > IMPORT_ERRORS_SHOWN:
+            lines.append(f"... та ще {len(errors) - IMPORT_ERRORS_SHOWN}")
+    return "\n".join(lines)
+
+async def import_from_file(content, fmt="xlsx", dry_run=False, prune=False):
+    """Імпорт даних з файлу (xlsx, csv.zip, jsonl.gz або parquet.zip; вміст у пам'яті) як набору змін
+    до поточних даних. Повертає (успіх, текстовий звіт); з dry_run лише показує різницю"""
+    if fmt == "parquet" and not PARQUET_AVAILABLE:
+        return False, "Для імпорту Parquet на сервері потрібен пакет pyarrow."
+    try:
+        diff, errors = await run_excel_job(parse_import_file, content, fmt, safe_json_read(DATA_FILE))
+        if dry_run:
+            return True, format_import_diff(diff, errors, dry_run=True, prune=prune)
+
+        # Різниця застосовується до свіжих даних одним записом: зміни, що надійшли під час читання файлу, не губляться
+        data = apply_import_diff(safe_json_read(DATA_FILE), diff, prune=prune)
+        if not safe_json_write(data, DATA_FILE):
+            return False, "Помилка при збереженні даних"
+
+        # Стан у пам'яті перебудовується лише після успішного запису
+        STATS.update(rebuild_stats({**data, "stats": STATS}))
+        stats_state["dirty"] = True
+        reset_moderation_views()
+        invalidate_list_indexes()
+        reload_role_table(data)
+        rebuild_search_index()
+        return True, format_import_diff(diff, errors, prune=prune)
+
+    except asyncio.TimeoutError:
+        print(f"Импорт из Excel не завершился за {EXCEL_TIMEOUT} с и был отменён")
+        return False, "Помилка при імпорті даних: перевищено час обробки файлу"
     except Exception as e:
         print(f"Ошибка при импорте из Excel: {e}")
-        return False
+        return False, "Помилка при імпорті даних"
 
 
 async def auto_delete_message(bot, chat_id, message_id, delay):
@@ -543,6 +1595,34 @@ async def auto_delete_message(bot, chat_id, message_id, delay):
     except Exception as e:
         print(f"Unexpected error deleting message: {e}")
 
+async def acknowledge_message(bot, message, fallback_text, success=True, delay=5, reaction=None):
+    """Підтвердження доставки реакцією на повідомлення, текстове підтвердження лише якщо реакції недоступні.
+    Невдача позначається реакцією і все одно супроводжується текстом: з 👎 не видно, що саме сталося"""
+    chat_id = message.chat.id
+    if ACK_MODE == "reaction" and chat_id not in reactions_unavailable_chats:
+        try:
+            await bot.set_message_reaction(
+                chat_id=chat_id,
+                message_id=message.message_id,
+                reaction=reaction or (ACK_REACTION_OK if success else ACK_REACTION_FAIL)
+            )
+            if success:
+                return
+        except telegram.error.BadRequest as e:
+            if "not found" not in str(e):
+                print(f"Реакції недоступні в чаті {chat_id}: {e}")
+                reactions_unavailable_chats.add(chat_id)
+        except Exception as e:
+            print(f"Помилка при встановленні реакції: {e}")
+
+    try:
+        reply = await message.reply_text(fallback_text)
+        if delay:
+            asyncio.create_task(
+                auto_delete_message(bot, chat_id=reply.chat.id, message_id=reply.message_id, delay=delay))
+    except Exception as e:
+        print(f"Помилка при відправці підтвердження: {e}")
+
 # ОСНОВНІ КОМАНДИ БОТА
 async def start(update: Update, context):
     """Обробка команди /start - запуск бота"""
@@ -574,7 +1654,8 @@ async def start(update: Update, context):
                 "reason": None
             }
             config["users"].append(new_user)
-            safe_json_write(config, DATA_FILE)
+            if safe_json_write(config, DATA_FILE):
+                register_new_user(new_user)
 
             # Создаём тему для нового пользователя
             topic_id = await get_or_create_topic(context, user.id, user.first_name)
@@ -679,7 +1760,14 @@ async def button_callback(update: Update, context):
         data["total_score"] = total_score
         data["num_of_ratings"] = num_of_ratings
 
-        safe_json_write(data, DATA_FILE)
+        # Лічильники та індекси змінюються лише після успішного запису, як і в save_moderation_changes
+        if not safe_json_write(data, DATA_FILE):
+            await query.edit_message_text("Сталася помилка при збереженні вашого відгуку.")
+            return
+        stats_rating_changed(previous_rating, new_rating)
+        invalidate_list_indexes()
+        if not user_found:
+            register_new_user(new_user)
 
         average_rating = total_score / num_of_ratings if num_of_ratings > 0 else 0
         await query.edit_message_text(
@@ -693,16 +1781,13 @@ async def button_callback(update: Update, context):
 async def message(update: Update, context):
     """Обробка команди /message - надсилання повідомлення адмінам"""
     try:
-        muted_users = load_muted_users_from_file()
         user_id = update.message.from_user.id
 
-        if str(user_id) in muted_users:
-            mute_info = muted_users[str(user_id)]
-            if mute_info['expiration'] and mute_info['expiration'] > datetime.now():
-                reply = await update.message.reply_text("Ви в муті й не можете надсилати повідомлення.")
-                await asyncio.create_task(
-                    auto_delete_message(context.bot, chat_id=reply.chat.id, message_id=reply.message_id, delay=10))
-                return
+        if is_user_restricted(str(user_id)):
+            reply = await update.message.reply_text("Ви в муті й не можете надсилати повідомлення.")
+            await asyncio.create_task(
+                auto_delete_message(context.bot, chat_id=reply.chat.id, message_id=reply.message_id, delay=10))
+            return
 
         context.user_data['waiting_for_message'] = True
         reply = await update.message.reply_text(
@@ -738,8 +1823,11 @@ async def help(update: Update, context):
                 "Відповісти на повідомлення бота - Надіслати повідомлення користувачу, який надіслав це повідомлення.\n"
                 "/mute <час> <користувач> 'причина' - Замутити користувача на вказаний час.\n"
                 "/unmute <користувач> - Розмутити користувача.\n"
-                "/mutelist - Показати список замучених користувачів.\n"
-                "/alllist - Показати всіх користувачів.\n"
+                "/mutelist [join|rating|username|mute] - Показати список замучених користувачів.\n"
+                "/alllist [join|rating|username|mute] - Показати всіх користувачів.\n"
+                "/find <запит> - Знайти користувача за username, ім'ям або id.\n"
+                "/stats - Показати статистику бота.\n"
+                "/reconcile - Застосувати в чаті бани та мути з даних (після імпорту).\n"
                 "/fromus - Інформація про створювача.\n"
                 "/help - Показати доступні команди.\n"
                 "/info - Показати інформацію про програмістів та адміністраторів.\n"
@@ -747,8 +1835,9 @@ async def help(update: Update, context):
                 "/deleteadmin <користувач> - Видалити адміністратора.\n"
                 "/programier <користувач> - Додати програміста.\n"
                 "/deleteprogramier <користувач> - Видалити програміста.\n"
-                "/get_alllist - Отримати Excel файл з користувачами.\n"
-                "/set_alllist - Записати Excel файл з користувачами.\n"
+                "/get_alllist [xlsx|csv|jsonl|parquet] [status=muted] [since=7d] [rating<3] [sheets=users] - "
+                "Отримати файл з користувачами (since - за датою заходу).\n"
+                "/set_alllist [dry] [prune] - Записати Excel файл з користувачами (dry - лише перевірка, prune - видалити відсутні у файлі).\n"
             )
         else:
             help_text = (
@@ -799,7 +1888,7 @@ async def info(update: Update, context: CallbackContext):
 async def mute(update: Update, context: CallbackContext):
     """Обробка команди /mute - обмеження користувача"""
     try:
-        user = update.message.from_user.username
+        user = update.message.from_user
         if not is_programmer(user) and not is_admin(user):
             await update.message.reply_text("Ця команда доступна лише адміністраторам.")
             return
@@ -815,7 +1904,7 @@ async def mute(update: Update, context: CallbackContext):
             await update.message.reply_text("Не вдалося визначити користувача для цієї теми.")
             return
 
-        if user_id in data["banned_users"]:
+        if user_id in get_moderation_views()["banned"]:
             await update.message.reply_text("❌ Цей користувач забанений і не може бути замучений!")
             return
 
@@ -839,19 +1928,8 @@ async def mute(update: Update, context: CallbackContext):
             await update.message.reply_text("Неможливо замутити власника чату.")
             return
 
-        mute_end = (datetime.now() + timedelta(seconds=mute_time)).strftime("%H:%M; %d/%m/%Y")
-        user_data.update({
-            "mute": True,
-            "mute_end": mute_end,
-            "reason": reason
-        })
-
-        data["muted_users"][user_id] = {
-            "expiration": mute_end,
-            "reason": reason
-        }
-
-        safe_json_write(data, DATA_FILE)
+        mute_end = mute_user_in_data(data, user_id, mute_time, reason)
+        save_moderation_changes(data, [(user_id, "muted", data["muted_users"][user_id])])
 
         mute_permissions = ChatPermissions(
             can_send_messages=False,
@@ -873,6 +1951,7 @@ async def mute(update: Update, context: CallbackContext):
             permissions=mute_permissions,
             until_date=int((datetime.now() + timedelta(seconds=mute_time)).timestamp())
         )
+        mark_enforced([(user_id, "muted", data["muted_users"][user_id])])
 
         try:
             await context.bot.send_message(
@@ -893,7 +1972,7 @@ async def mute(update: Update, context: CallbackContext):
 async def unmute(update: Update, context: CallbackContext):
     """Обробка команди /unmute - зняття обмежень"""
     try:
-        user = update.message.from_user.username
+        user = update.message.from_user
         if not is_programmer(user) and not is_admin(user):
             await update.message.reply_text("Ця команда доступна лише адміністраторам.")
             return
@@ -909,7 +1988,8 @@ async def unmute(update: Update, context: CallbackContext):
             await update.message.reply_text("Не вдалося визначити користувача для цієї теми.")
             return
 
-        if user_id in data["banned_users"]:
+        views = get_moderation_views()
+        if user_id in views["banned"]:
             await update.message.reply_text("❌ Цей користувач забанений! Використовуйте /unban для розбану.")
             return
 
@@ -918,7 +1998,7 @@ async def unmute(update: Update, context: CallbackContext):
             await update.message.reply_text("Користувача не знайдено.")
             return
 
-        if not user_data["mute"]:
+        if user_id not in views["muted"]:
             await update.message.reply_text("Цей користувач не в муті.")
             return
 
@@ -928,10 +2008,8 @@ async def unmute(update: Update, context: CallbackContext):
             "reason": None
         })
 
-        if user_id in data["muted_users"]:
-            del data["muted_users"][user_id]
-
-        safe_json_write(data, DATA_FILE)
+        data["muted_users"].pop(user_id, None)
+        save_moderation_changes(data, [(user_id, "active", None)])
 
         unmute_permissions = ChatPermissions(
             can_send_messages=True,
@@ -952,6 +2030,7 @@ async def unmute(update: Update, context: CallbackContext):
             user_id=int(user_id),
             permissions=unmute_permissions
         )
+        mark_enforced([(user_id, "active", None)])
 
         try:
             await context.bot.send_message(
@@ -970,7 +2049,7 @@ async def unmute(update: Update, context: CallbackContext):
 async def ban(update: Update, context: CallbackContext):
     """Обробка команди /ban - бан користувача"""
     try:
-        user = update.message.from_user.username
+        user = update.message.from_user
         if not is_programmer(user) and not is_admin(user):
             await update.message.reply_text("Ця команда доступна лише адміністраторам.")
             return
@@ -1015,12 +2094,13 @@ async def ban(update: Update, context: CallbackContext):
             "reason": f"Забанен: {reason}"
         }
 
-        safe_json_write(data, DATA_FILE)
+        save_moderation_changes(data, [(user_id, "banned", data["banned_users"][user_id])])
 
         await context.bot.ban_chat_member(
             chat_id=data["chat_id"],
             user_id=int(user_id)
         )
+        mark_enforced([(user_id, "banned", data["banned_users"][user_id])])
 
         try:
             await context.bot.send_message(
@@ -1040,7 +2120,7 @@ async def ban(update: Update, context: CallbackContext):
 async def unban(update: Update, context: CallbackContext):
     """Обробка команди /unban - розбан користувача"""
     try:
-        user = update.message.from_user.username
+        user = update.message.from_user
         if not is_programmer(user) and not is_admin(user):
             await update.message.reply_text("Ця команда доступна лише адміністраторам.")
             return
@@ -1056,11 +2136,11 @@ async def unban(update: Update, context: CallbackContext):
             await update.message.reply_text("Не вдалося визначити користувача для цієї теми.")
             return
 
-        if user_id not in data["banned_users"]:
+        if user_id not in get_moderation_views()["banned"]:
             await update.message.reply_text("Цей користувач не забанений.")
             return
 
-        del data["banned_users"][user_id]
+        data["banned_users"].pop(user_id, None)
 
         user_data = next((u for u in data["users"] if u["id"] == user_id), None)
         if user_data:
@@ -1070,10 +2150,8 @@ async def unban(update: Update, context: CallbackContext):
                 "reason": None
             })
 
-        if user_id in data["muted_users"]:
-            del data["muted_users"][user_id]
-
-        safe_json_write(data, DATA_FILE)
+        data["muted_users"].pop(user_id, None)
+        save_moderation_changes(data, [(user_id, "active", None)])
 
         await context.bot.unban_chat_member(
             chat_id=int(data["chat_id"]),
@@ -1099,6 +2177,7 @@ async def unban(update: Update, context: CallbackContext):
             user_id=int(user_id),
             permissions=unmute_permissions
         )
+        mark_enforced([(user_id, "active", None)])
 
         try:
             await context.bot.send_message(
@@ -1114,74 +2193,235 @@ async def unban(update: Update, context: CallbackContext):
         print(f"Помилка в команді unban: {e}")
         await update.message.reply_text("❌ Сталася помилка при обробці команди.")
 
+# ЗАСТОСУВАННЯ МОДЕРАЦІЇ В TELEGRAM
+def enforced_entry(status, info=None):
+    """Запис про стан, фактично застосований у чаті (None - обмежень немає)"""
+    if status == "banned":
+        return {"status": "banned"}
+    if status == "muted":
+        return {"status": "muted", "until": (info or {}).get("expiration")}
+    return None
+
+def set_enforced(data, changes):
+    """Оновлення data["enforced"] для змін (user_id, статус, info), уже застосованих у чаті"""
+    enforced = data.setdefault("enforced", {})
+    for user_id, status, info in changes:
+        entry = enforced_entry(status, info)
+        if entry is None:
+            enforced.pop(user_id, None)
+        else:
+            enforced[user_id] = entry
+
+def seed_enforced(data):
+    """Одноразова міграція: без data["enforced"] вважаємо, що поточні бани та мути вже застосовані в чаті,
+    інакше перше узгодження повторно забанило б і замутило всіх зі збережених списків. Повертає True, якщо засіяно"""
+    if "enforced" in data:
+        return False
+    views = build_moderation_views(data)
+    now = time.time()
+    set_enforced(data, [(user_id, "banned", None) for user_id in views["banned"]] +
+                 [(user_id, "muted", info.to_json()) for user_id, info in views["muted"].items() if info.is_active(now)])
+    return True
+
+def migrate_enforced():
+    """Засівання data["enforced"] при запуску, якщо його ще немає"""
+    data = safe_json_read(DATA_FILE)
+    if seed_enforced(data):
+        safe_json_write(data, DATA_FILE)
+
+def mark_enforced(changes):
+    """Позначення змін як застосованих у чаті - викликається лише після успішного виклику Telegram,
+    тож невдалі дії залишаються для наступного /reconcile"""
+    data = safe_json_read(DATA_FILE)
+    set_enforced(data, changes)
+    return safe_json_write(data, DATA_FILE)
+
+def plan_reconciliation(data):
+    """Дії, потрібні, щоб стан у чаті відповідав даним: ban/unban/mute/unmute"""
+    views = build_moderation_views(data)
+    enforced = data.get("enforced", {})
+    owner_id = str(data.get("owner_id", ""))
+    now = time.time()
+    actions = []
+
+    for user_id in views["banned"]:
+        if enforced.get(user_id, {}).get("status") != "banned":
+            actions.append(("ban", user_id, None))
+
+    for user_id, info in views["muted"].items():
+        # Прострочені мути знімає check_mute_expirations
+        if not info.is_active(now):
+            continue
+        if enforced.get(user_id) != enforced_entry("muted", info.to_json()):
+            actions.append(("mute", user_id, info))
+
+    for user_id, entry in enforced.items():
+        if user_id not in views["banned"] and user_id not in views["muted"]:
+            actions.append(("unban" if entry.get("status") == "banned" else "unmute", user_id, None))
+
+    return [action for action in actions if action[1] != owner_id]
+
+async def apply_moderation_action(bot, chat_id, action, user_id, info):
+    """Один виклик Telegram API для дії узгодження"""
+    if action == "ban":
+        await bot.ban_chat_member(chat_id=chat_id, user_id=int(user_id))
+    elif action == "unban":
+        await bot.unban_chat_member(chat_id=chat_id, user_id=int(user_id), only_if_banned=True)
+    elif action == "mute":
+        await bot.restrict_chat_member(
+            chat_id=chat_id,
+            user_id=int(user_id),
+            permissions=ChatPermissions.no_permissions(),
+            until_date=info.until
+        )
+    elif action == "unmute":
+        await bot.restrict_chat_member(chat_id=chat_id, user_id=int(user_id), permissions=ChatPermissions.all_permissions())
+
+async def reconcile_moderation(bot, progress=None):
+    """Узгодження стану чату з даними: дії виконуються паралельно з обмеженням кількості
+    одночасних запитів і темпу; повертає {дія: [успішно, помилок]}"""
+    data = safe_json_read(DATA_FILE)
+    summary = {action: [0, 0] for action in ("ban", "unban", "mute", "unmute")}
+    if seed_enforced(data):
+        # Перший запуск без міграції: лише запам'ятовуємо поточний стан, нічого не застосовуючи
+        safe_json_write(data, DATA_FILE)
+        return summary
+
+    actions = plan_reconciliation(data)
+    if not actions:
+        return summary
+
+    chat_id = int(data["chat_id"])
+    semaphore = asyncio.Semaphore(RECONCILE["concurrency"])
+    loop = asyncio.get_running_loop()
+    pace = {"next": loop.time()}
+    done = {"count": 0, "reported": 0.0}
+    applied = {}
+
+    async def run(action, user_id, info):
+        async with semaphore:
+            for attempt in range(RECONCILE["retries"] + 1):
+                # Рівномірний темп запитів, щоб не впертися в ліміти Telegram
+                slot = max(loop.time(), pace["next"])
+                pace["next"] = slot + 1 / RECONCILE["per_second"]
+                await asyncio.sleep(slot - loop.time())
+                try:
+                    await apply_moderation_action(bot, chat_id, action, user_id, info)
+                    applied[user_id] = (user_id, {"ban": "banned", "mute": "muted"}.get(action, "active"),
+                                        info.to_json() if info else None)
+                    summary[action][0] += 1
+                    break
+                except telegram.error.RetryAfter as e:
+                    retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                    pace["next"] = max(pace["next"], loop.time() + retry_after)
+                except Exception as e:
+                    print(f"Помилка узгодження ({action}) для користувача {user_id}: {e}")
+                    summary[action][1] += 1
+                    break
+            else:
+                summary[action][1] += 1
+
+        done["count"] += 1
+        if progress and (done["count"] == len(actions) or loop.time() - done["reported"] >= RECONCILE["progress_interval"]):
+            done["reported"] = loop.time()
+            await progress(done["count"], len(actions))
+
+    await asyncio.gather(*(run(*action) for action in actions))
+
+    # Один запис у кінці: свіжі дані + результати застосування
+    if applied:
+        mark_enforced(applied.values())
+    return summary
+
+def format_reconcile_summary(summary):
+    """Текстовий підсумок узгодження"""
+    titles = {"ban": "Забанено", "unban": "Розбанено", "mute": "Замучено", "unmute": "Розмучено"}
+    lines = [f"{titles[action]}: {ok}" + (f" (помилок: {failed})" if failed else "")
+             for action, (ok, failed) in summary.items() if ok or failed]
+    if not lines:
+        return "✅ Стан чату вже відповідає даним, змін не потрібно."
+    return "✅ Узгодження завершено:\n" + "\n".join(lines)
+
+async def run_reconciliation(bot, message):
+    """Узгодження з відображенням прогресу в повідомленні"""
+    status_msg = await message.reply_text("⏳ Узгодження стану чату з даними...")
+
+    async def progress(done, total):
+        try:
+            await status_msg.edit_text(f"⏳ Узгодження стану чату: {done}/{total}")
+        except telegram.error.BadRequest:
+            pass
+
+    summary = await reconcile_moderation(bot, progress)
+    await status_msg.edit_text(format_reconcile_summary(summary))
+
 async def check_mute_expirations():
-    """Перевірка закінчення часу муту"""
+    """Перевірка закінчення часу муту (перебираються лише замучені користувачі)"""
     try:
+        now = time.time()
+        expired_ids = [
+            user_id for user_id, mute_info in get_moderation_views()["muted"].items()
+            if mute_info.until and mute_info.until <= now
+        ]
+        if not expired_ids:
+            return
+
         application = Application.builder().token(BOTTOCEN).build()
         async with application:
             context = ContextTypes.DEFAULT_TYPE(application=application)
 
             data = safe_json_read(DATA_FILE)
-            now = datetime.now()
-            users_to_unmute = []
-
-            for user in data["users"]:
-                if user["mute"] and user["mute_end"]:
-                    try:
-                        mute_end = datetime.strptime(user["mute_end"], "%H:%M; %d/%m/%Y")
-                        if mute_end <= now:
-                            users_to_unmute.append(user)
-                    except ValueError:
-                        continue
+            users_by_id = {user["id"]: user for user in data["users"]}
+            unrestricted = []
 
-            if users_to_unmute:
-                for user in users_to_unmute:
+            for user_id in expired_ids:
+                user = users_by_id.get(user_id)
+                if user:
                     user.update({
                         "mute": False,
                         "mute_end": None,
                         "reason": None
                     })
 
-                    if "muted_users" in data and user["id"] in data["muted_users"]:
-                        del data["muted_users"][user["id"]]
+                data["muted_users"].pop(user_id, None)
 
-                    try:
-                        await context.bot.restrict_chat_member(
-                            chat_id=int(data["chat_id"]),
-                            user_id=int(user["id"]),
-                            permissions=ChatPermissions(
-                                can_send_messages=True,
-                                can_send_photos=True,
-                                can_send_videos=True,
-                                can_send_audios=True,
-                                can_send_documents=True,
-                                can_send_polls=True,
-                                can_send_other_messages=True,
-                                can_add_web_page_previews=True,
-                                can_change_info=True,
-                                can_invite_users=True,
-                                can_pin_messages=True
-                            )
+                try:
+                    await context.bot.restrict_chat_member(
+                        chat_id=int(data["chat_id"]),
+                        user_id=int(user_id),
+                        permissions=ChatPermissions(
+                            can_send_messages=True,
+                            can_send_photos=True,
+                            can_send_videos=True,
+                            can_send_audios=True,
+                            can_send_documents=True,
+                            can_send_polls=True,
+                            can_send_other_messages=True,
+                            can_add_web_page_previews=True,
+                            can_change_info=True,
+                            can_invite_users=True,
+                            can_pin_messages=True
                         )
+                    )
+                    unrestricted.append((user_id, "active", None))
 
-                        try:
-                            await context.bot.send_message(
-                                chat_id=int(user["id"]),
-                                text="🔊 Ваш мут закінчився. Тепер ви знову можете писати в чат."
-                            )
-                        except Exception as e:
-                            print(f"Помилка сповіщення користувача про закінчення муту: {e}")
-
+                    try:
+                        await context.bot.send_message(
+                            chat_id=int(user_id),
+                            text="🔊 Ваш мут закінчився. Тепер ви знову можете писати в чат."
+                        )
                     except Exception as e:
-                        print(f"Помилка при розмуті користувача {user['id']}: {e}")
+                        print(f"Помилка сповіщення користувача про закінчення муту: {e}")
 
-                print(f"Дані перед збереженням: {data['users']}")
-                if not safe_json_write(data, DATA_FILE):
-                    print("Помилка збереження даних")
-                else:
-                    print("Дані успішно збережено")
-                    check_data = safe_json_read(DATA_FILE)
-                    print(f"Дані після збереження: {check_data['users']}")
+                except Exception as e:
+                    print(f"Помилка при розмуті користувача {user_id}: {e}")
+
+            # Невдалі розмути залишаються в enforced, їх повторить /reconcile
+            set_enforced(data, unrestricted)
+            if not save_moderation_changes(data, [(user_id, "active", None) for user_id in expired_ids]):
+                print("Помилка збереження даних")
+            else:
+                print(f"Розмучено користувачів: {len(expired_ids)}")
 
     except Exception as e:
         print(f"Помилка в перевірці строків муту: {e}")
@@ -1189,7 +2429,7 @@ async def check_mute_expirations():
 async def admin(update: Update, context: CallbackContext):
     """Обробка команди /admin - додавання адміністратора"""
     try:
-        user = update.message.from_user.username
+        user = update.message.from_user
         if not is_programmer(user):
             await update.message.reply_text("Ця команда доступна тільки програмістам.")
             return
@@ -1205,7 +2445,8 @@ async def admin(update: Update, context: CallbackContext):
             await update.message.reply_text(f"Користувач @{username} вже є адміністратором.")
         else:
             data["admins"].append(username)
-            safe_json_write(data, DATA_FILE)
+            if safe_json_write(data, DATA_FILE):
+                set_user_role(username, "admin", True)
             await update.message.reply_text(f"👮 Користувач @{username} доданий до списку адміністраторів.")
     except Exception as e:
         print(f"Помилка в admin: {e}")
@@ -1214,7 +2455,7 @@ async def admin(update: Update, context: CallbackContext):
 async def deleteadmin(update: Update, context: CallbackContext):
     """Обробка команди /deleteadmin - видалення адміністратора"""
     try:
-        user = update.message.from_user.username
+        user = update.message.from_user
         if not is_programmer(user):
             await update.message.reply_text("Ця команда доступна тільки програмістам.")
             return
@@ -1228,7 +2469,8 @@ async def deleteadmin(update: Update, context: CallbackContext):
 
         if username in data["admins"]:
             data["admins"].remove(username)
-            safe_json_write(data, DATA_FILE)
+            if safe_json_write(data, DATA_FILE):
+                set_user_role(username, "admin", False)
             await update.message.reply_text(f"👮 Користувач @{username} видалений зі списку адміністраторів.")
         else:
             await update.message.reply_text(f"Користувач @{username} не знайдений.")
@@ -1239,7 +2481,7 @@ async def deleteadmin(update: Update, context: CallbackContext):
 async def programier(update: Update, context: CallbackContext):
     """Обробка команди /programier - додавання програміста"""
     try:
-        user = update.message.from_user.username
+        user = update.message.from_user
         if not is_programmer(user):
             await update.message.reply_text("Ця команда доступна тільки програмістам.")
             return
@@ -1255,7 +2497,8 @@ async def programier(update: Update, context: CallbackContext):
             await update.message.reply_text(f"Користувач @{username} вже є програмістом.")
         else:
             data["programmers"].append(username)
-            safe_json_write(data, DATA_FILE)
+            if safe_json_write(data, DATA_FILE):
+                set_user_role(username, "programmer", True)
             await update.message.reply_text(f"👨‍💻 Користувач @{username} доданий до списку програмістів.")
     except Exception as e:
         print(f"Помилка в programier: {e}")
@@ -1264,7 +2507,7 @@ async def programier(update: Update, context: CallbackContext):
 async def deleteprogramier(update: Update, context: CallbackContext):
     """Обробка команди /deleteprogramier - видалення програміста"""
     try:
-        user = update.message.from_user.username
+        user = update.message.from_user
         if not is_programmer(user):
             await update.message.reply_text("Ця команда доступна тільки програмістам.")
             return
@@ -1280,7 +2523,8 @@ async def deleteprogramier(update: Update, context: CallbackContext):
             await update.message.reply_text(f"Неможливо видалити {username} зі списку програмістів.")
         elif username in data["programmers"]:
             data["programmers"].remove(username)
-            safe_json_write(data, DATA_FILE)
+            if safe_json_write(data, DATA_FILE):
+                set_user_role(username, "programmer", False)
             await update.message.reply_text(f"👨‍💻 Користувач @{username} видалений зі списку програмістів.")
         else:
             await update.message.reply_text(f"Користувач @{username} не є програмістом.")
@@ -1288,168 +2532,524 @@ async def deleteprogramier(update: Update, context: CallbackContext):
         print(f"Помилка в deleteprogramier: {e}")
         await update.message.reply_text("Сталася помилка при обробці команди.")
 
+# ДОВІДНИК ПРОФІЛІВ
+async def track_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Оновлення довідника профілів з кожного вхідного оновлення (без запитів до API)"""
+    user = update.effective_user
+    if user is None or user.is_bot:
+        return
+
+    user_id = str(user.id)
+    username = user.username or "Не вказано"
+    first_name = user.first_name or "Не вказано"
+    now = time.monotonic()
+
+    entry = profile_directory.get(user_id)
+    if entry is None:
+        entry = profile_directory[user_id] = {}
+        profile_dirty.add(user_id)
+    elif entry["username"] != username or entry["first_name"] != first_name:
+        profile_dirty.add(user_id)
+
+    entry.update({
+        "username": username,
+        "first_name": first_name,
+        "full_name": user.full_name or first_name
+    })
+    last_seen_times[user_id] = get_current_time_kiev()
+    seen_state["dirty"] = True
+
+    if user_id in profile_cache:
+        profile_cache[user_id] = (user.first_name, user.username, now)
+
+    # Ролі прив'язані до ID: після зміни юзернейму власника прив'язки вони переходять на новий
+    role_username = role_table.get("by_id", {}).get(user_id)
+    if role_username and user.username and role_username != user.username:
+        rename_role_holder(user_id, user.username)
+
+    if user_id in profile_dirty and user_id in search_index["terms"]:
+        search_index_update(user_id, username, first_name)
+
+async def flush_pending_changes():
+    """Пакетне збереження: лічильники статистики та last_seen - в окремі файли, які не скидають кеші data.json;
+    змінені username/first_name у users[], нові юзернейми у списках ролей і прив'язки ролей до ID - у data.json.
+    Працює в циклі подій, тож читання-зміна-запис data.json не змагається з обробниками"""
+    try:
+        if stats_state["dirty"]:
+            await save_stats()
+        if seen_state["dirty"] and time.monotonic() - seen_state["flushed_at"] >= PROFILE_SEEN_FLUSH_INTERVAL:
+            await save_last_seen()
+    except Exception as e:
+        print(f"Помилка при збереженні статистики: {e}")
+
+    if not profile_dirty and not role_state["dirty"]:
+        return
+    try:
+        dirty = set(profile_dirty)
+        profile_dirty.clear()
+        renames = dict(role_renames)
+        role_renames.clear()
+        roles_dirty = role_state["dirty"]
+        role_state["dirty"] = False
+
+        data = safe_json_read(DATA_FILE)
+        changed = False
+        for user in data.get("users", []):
+            entry = profile_directory.get(user["id"])
+            if user["id"] not in dirty or entry is None:
+                continue
+            if user.get("username") != entry["username"] or user.get("first_name") != entry["first_name"]:
+                user["username"] = entry["username"]
+                user["first_name"] = entry["first_name"]
+                changed = True
+
+        for old_username, new_username in renames.items():
+            for section in ROLE_SECTIONS.values():
+                names = data.get(section, [])
+                if old_username in names:
+                    names.remove(old_username)
+                    if new_username not in names:
+                        names.append(new_username)
+                    changed = True
+
+        if roles_dirty:
+            data["role_ids"] = dict(get_role_table()["owner"])
+            changed = True
+
+        if changed:
+            if safe_json_write(data, DATA_FILE):
+                invalidate_list_indexes()
+            else:
+                profile_dirty.update(dirty)
+                role_renames.update(renames)
+                role_state["dirty"] = role_state["dirty"] or roles_dirty
+    except Exception as e:
+        print(f"Помилка при збереженні довідника профілів: {e}")
+
+async def resolve_profiles(bot, chat_id, user_ids, users_info):
+    """Отримання (first_name, username) користувачів: спершу з кешу, решта - паралельними запитами.
+    Якщо API недоступне, використовуються збережені дані з users[]"""
+    now = time.monotonic()
+    profiles = {}
+    missing = []
+
+    for user_id in user_ids:
+        seen = profile_directory.get(user_id)
+        if seen:
+            username = seen["username"]
+            profiles[user_id] = (seen["first_name"], None if username == "Не вказано" else username)
+            continue
+        cached = profile_cache.get(user_id)
+        if cached and now - cached[2] < PROFILE_CACHE_TTL:
+            profiles[user_id] = cached[:2]
+        else:
+            missing.append(user_id)
+
+    semaphore = asyncio.Semaphore(PROFILE_FETCH_CONCURRENCY)
+
+    async def fetch_profile(user_id):
+        async with semaphore:
+            try:
+                member = await asyncio.wait_for(bot.get_chat_member(chat_id=chat_id, user_id=int(user_id)), timeout=5)
+                profile = (member.user.first_name, member.user.username)
+                profile_cache[user_id] = (*profile, time.monotonic())
+            except Exception as e:
+                print(f"Не вдалося отримати профіль {user_id}: {e}")
+                stored = users_info.get(user_id)
+                username = stored.username if stored else None
+                profile = (stored.first_name if stored else None, None if username == NOT_SPECIFIED else username)
+                # Запам'ятовуємо збережені дані ненадовго, щоб не повторювати невдалі запити при кожному виклику
+                profile_cache[user_id] = (*profile, time.monotonic() - PROFILE_CACHE_TTL * 0.9)
+            return user_id, profile
+
+    for user_id, profile in await asyncio.gather(*(fetch_profile(user_id) for user_id in missing)):
+        profiles[user_id] = profile
+
+    return profiles
+
+def get_list_indexes():
+    """Відсортовані індекси користувачів для /alllist та /mutelist, перебудовуються лише після
+    invalidate_list_indexes (не після кожного запису data.json: пересилання, enforced тощо списків не змінюють)"""
+    if list_indexes:
+        return list_indexes
+
+    data = safe_json_read(DATA_FILE)
+    users = {user["id"]: UserRecord.from_json(user) for user in data.get("users", [])}
+    muted_views = get_moderation_views()["muted"]
+    muted_ids = [user_id for user_id in muted_views if user_id in users]
+
+    sort_keys = {
+        "join": lambda user_id: users[user_id].joined or 0,
+        "rating": lambda user_id: -users[user_id].rating,
+        "username": lambda user_id: users[user_id].username.casefold(),
+        "mute": lambda user_id: (muted_views[user_id].until if user_id in muted_views else None) or math.inf,
+    }
+
+    list_indexes.clear()
+    list_indexes.update({
+        "chat_id": data["chat_id"],
+        "users": users,
+        "topics": data.get("topics", {}),
+        "admins": set(data.get("admins", [])),
+        "programmers": set(data.get("programmers", [])),
+        "all": {key: sorted(users, key=sort_key) for key, sort_key in sort_keys.items()},
+        "muted": {key: sorted(muted_ids, key=sort_key) for key, sort_key in sort_keys.items()},
+    })
+    return list_indexes
+
+def invalidate_list_indexes():
+    """Скидання індексів списків після змін користувачів, оцінок, профілів, ролей, тем або модерації"""
+    list_indexes.clear()
+
+async def render_user_list_page(bot, kind, sort_key, page):
+    """Формування однієї сторінки списку користувачів ("all" або "muted") з кнопками навігації"""
+    indexes = get_list_indexes()
+    user_ids = indexes[kind][sort_key]
+    total_pages = max(1, -(-len(user_ids) // LIST_PAGE_SIZE))
+    page = min(max(page, 0), total_pages - 1)
+    page_ids = user_ids[page * LIST_PAGE_SIZE:(page + 1) * LIST_PAGE_SIZE]
+
+    users_info = indexes["users"]
+    views = get_moderation_views()
+    profiles = await resolve_profiles(bot, indexes["chat_id"], page_ids, users_info)
+
+    title = "Користувачі" if kind == "all" else "Замучені користувачі"
+    response = f"{title} ({len(user_ids)}), сортування за {LIST_SORT_KEYS[sort_key]}:\n"
+
+    for user_id in page_ids:
+        user_data = users_info.get(user_id)
+        first_name, username = profiles[user_id]
+        user_fullname = first_name or "Невідомий"
+        username = username or "Немає імені користувача"
+        join_date = (user_data.join_date if user_data else None) or 'Невідома'
+        rating = user_data.rating if user_data else 0
+
+        admins_sumdol = "👨🏻‍💼"
+        if username in indexes["admins"]:
+            admins_sumdol = "👮🏻‍♂️"
+        if username in indexes["programmers"]:
+            admins_sumdol = "👨🏻‍💻"
+
+        mute_info = views["muted"].get(user_id)
+        mute_symbol = "🔇" if mute_info else "🚫" if user_id in views["banned"] else "🔊"
+
+        response += f"{admins_sumdol} {mute_symbol} {user_fullname}; @{username} {user_id}\n"
+        if kind == "muted":
+            response += (
+                f"Залишилось: {mute_info.expiration or 'Невідомо'}\n"
+                f"Причина: {mute_info.reason or 'Без причини'}\n"
+            )
+        response += f"Дата заходу: {join_date}\nОцінка: {rating}⭐️\n"
+        response += "-------------------------------------------------------------------------\n"
+
+    if not page_ids:
+        response += "Немає користувачів.\n" if kind == "all" else "Немає замучених користувачів.\n"
+        response += "-------------------------------------------------------------------------\n"
+
+    keyboard = [
+        [
+            InlineKeyboardButton("◀", callback_data=f"list:{kind}:{sort_key}:{page - 1}"),
+            InlineKeyboardButton(f"{page + 1}/{total_pages}", callback_data="list:noop"),
+            InlineKeyboardButton("▶", callback_data=f"list:{kind}:{sort_key}:{page + 1}"),
+        ],
+        [
+            InlineKeyboardButton(("• " if key == sort_key else "") + key, callback_data=f"list:{kind}:{key}:0")
+            for key in LIST_SORT_KEYS
+        ],
+    ]
+    return response, InlineKeyboardMarkup(keyboard)
+
 async def mutelist(update: Update, context):
-    """Обробка команди /mutelist - список замучених користувачів"""
+    """Обробка команди /mutelist [сортування] - список замучених користувачів посторінково"""
     try:
-        user = update.message.from_user.username
-        if update.message.chat.id != CREATOR_CHAT_ID:
+        user = update.message.from_user
+        if str(update.message.chat.id) != str(CREATOR_CHAT_ID):
             if not is_programmer(user) and not is_admin(user):
                 reply = await update.message.reply_text("Ця команда доступна тільки адміністраторам бота.")
                 await asyncio.create_task(
                     auto_delete_message(context.bot, chat_id=reply.chat.id, message_id=reply.message_id, delay=10))
                 return
 
-        data = safe_json_read(DATA_FILE)
-        admins = data.get("admins", [])
-        programmers = data.get("programmers", [])
-        muted_users = {user['id']: user for user in data.get("users", []) if user.get("mute", False)}
-
-        response = "Замучені користувачі:\n"
-
-        if muted_users:
-            for user_id, mute_info in muted_users.items():
-                expiration = mute_info.get('mute_end', 'Невідомо')
-                reason = mute_info.get('reason', 'Без причини')
-
-                user_info = await context.bot.get_chat_member(chat_id=data["chat_id"], user_id=int(user_id))
-                user_fullname = user_info.user.first_name or "Невідомий"
-                username = user_info.user.username or "Немає імені користувача"
-
-                join_date = mute_info.get('join_date', 'Невідома')
-                rating = mute_info.get('rating', 0)
-                mute_symbol = "🔇"
-
-                admins_sumdol = "👨🏻‍💼"
-                if username in admins:
-                    admins_sumdol = "👮🏻‍♂️"
-                if username in programmers:
-                    admins_sumdol = "👨🏻‍💻"
-
-                response += (
-                    f"{admins_sumdol} {mute_symbol} {user_fullname}; @{username} {user_id}\n"
-                    f"Залишилось: {expiration}\n"
-                    f"Причина: {reason}\n"
-                    f"Дата заходу: {join_date}\n"
-                    f"Оцінка: {rating}⭐️\n"
-                    "-------------------------------------------------------------------------\n"
-                )
-        else:
-            response += "Немає замучених користувачів.\n"
-            response += "-------------------------------------------------------------------------\n"
-
-        await update.message.reply_text(response)
+        sort_key = context.args[0] if context.args and context.args[0] in LIST_SORT_KEYS else "mute"
+        response, reply_markup = await render_user_list_page(context.bot, "muted", sort_key, 0)
+        await update.message.reply_text(response, reply_markup=reply_markup)
     except Exception as e:
         print(f"Помилка в mutelist: {e}")
         await update.message.reply_text("Сталася помилка при обробці команди.")
 
 async def alllist(update: Update, context: CallbackContext):
-    """Обробка команди /alllist - список всіх користувачів"""
+    """Обробка команди /alllist [сортування] - список всіх користувачів посторінково"""
     try:
-        user = update.message.from_user.username
-        if update.message.chat.id != CREATOR_CHAT_ID:
+        user = update.message.from_user
+        if str(update.message.chat.id) != str(CREATOR_CHAT_ID):
             if not is_programmer(user) and not is_admin(user):
                 reply = await update.message.reply_text("Ця команда доступна лише адміністраторам бота.")
                 await asyncio.create_task(
                     auto_delete_message(context.bot, chat_id=reply.chat.id, message_id=reply.message_id, delay=10))
                 return
 
-        data = safe_json_read(DATA_FILE)
-        admins = data.get("admins", [])
-        programmers = data.get("programmers", [])
-        users_info = {user['id']: user for user in data.get("users", [])}
-        muted_users = {user['id']: user for user in data.get("users", []) if user.get("mute", False)}
-
-        response = "Користувачі:\n"
-        unique_users = {user['id'] for user in data.get("users", [])}
-
-        if unique_users:
-            for user_id in unique_users:
-                user_data = users_info.get(str(user_id), {})
-                user_info = await context.bot.get_chat_member(chat_id=data["chat_id"], user_id=int(user_id))
-                user_fullname = user_info.user.first_name or "Невідомий"
-                username = user_info.user.username or "Немає імені користувача"
-                join_date = user_data.get('join_date', 'Невідома')
-                rating = user_data.get('rating', 0)
-
-                admins_sumdol = "👨🏻‍💼"
-                if username in admins:
-                    admins_sumdol = "👮🏻‍♂️"
-                if username in programmers:
-                    admins_sumdol = "👨🏻‍💻"
-
-                mute_symbol = "🔇" if str(user_id) in muted_users else "🔊"
-
-                response += f"{admins_sumdol} {mute_symbol} {user_fullname}; @{username} {user_id}\nДата заходу: {join_date}\nОцінка: {rating}⭐️\n"
-                response += "-------------------------------------------------------------------------\n"
-        else:
-            response += "Немає користувачів.\n"
-            response += "-------------------------------------------------------------------------\n"
-
-        response += "==========================================\n"
-        response += "\n"
-        response += "==========================================\n"
-        response += "Замучені користувачі:\n"
-
-        if muted_users:
-            for user_id, mute_info in muted_users.items():
-                expiration = mute_info['mute_end'] or "Невідомо"
-                reason = mute_info.get('reason', "Без причини")
-                user_info = await context.bot.get_chat_member(chat_id=data["chat_id"], user_id=int(user_id))
-                user_fullname = user_info.user.first_name or "Невідомий"
-                username = user_info.user.username or "Немає імені користувача"
-                user_data = users_info.get(str(user_id), {})
-                join_date = user_data.get('join_date', 'Невідома')
-                rating = user_data.get('rating', 0)
-
-                admins_sumdol = "👨🏻‍💼"
-                if username in admins:
-                    admins_sumdol = "👮🏻‍♂️"
-                if username in programmers:
-                    admins_sumdol = "👨🏻‍💻"
-
-                mute_symbol = "🔇"
-
-                response += (
-                    f"{admins_sumdol} {mute_symbol} {user_fullname}; @{username} {user_id}\n"
-                    f"Залишилось: {str(expiration).split('.')[0]}\n"
-                    f"Причина: {reason}\n"
-                    f"Дата заходу: {join_date}\n"
-                    f"Оцінка: {rating}⭐️\n"
-                    "-------------------------------------------------------------------------\n"
-                )
-        else:
-            response += "Немає замучених користувачів.\n"
-            response += "-------------------------------------------------------------------------\n"
-
-        await update.message.reply_text(response)
+        sort_key = context.args[0] if context.args and context.args[0] in LIST_SORT_KEYS else "join"
+        response, reply_markup = await render_user_list_page(context.bot, "all", sort_key, 0)
+        await update.message.reply_text(response, reply_markup=reply_markup)
     except Exception as e:
         print(f"Помилка в alllist: {e}")
         await update.message.reply_text("Сталася помилка при обробці команди.")
 
+async def list_page_callback(update: Update, context: CallbackContext):
+    """Обробка кнопок навігації ◀ ▶ та сортування в /alllist і /mutelist"""
+    query = update.callback_query
+    try:
+        if query.data == "list:noop":
+            await query.answer()
+            return
+
+        user = query.from_user
+        if str(query.message.chat.id) != str(CREATOR_CHAT_ID):
+            if not is_programmer(user) and not is_admin(user):
+                await query.answer("Ця дія доступна лише адміністраторам бота.")
+                return
+
+        _, kind, sort_key, page = query.data.split(":")
+        if kind not in ("all", "muted") or sort_key not in LIST_SORT_KEYS:
+            await query.answer()
+            return
+
+        response, reply_markup = await render_user_list_page(context.bot, kind, sort_key, int(page))
+        await query.answer()
+        await query.edit_message_text(response, reply_markup=reply_markup)
+    except telegram.error.BadRequest as e:
+        if "not modified" not in str(e):
+            print(f"Помилка в list_page_callback: {e}")
+    except Exception as e:
+        print(f"Помилка в list_page_callback: {e}")
+
+async def stats(update: Update, context: CallbackContext):
+    """Обробка команди /stats - статистика бота з лічильників у пам'яті"""
+    try:
+        user = update.message.from_user
+        if not is_programmer(user) and not is_admin(user):
+            await update.message.reply_text("Ця команда доступна лише адміністраторам.")
+            return
+
+        if STATS.get("relayed_date") != get_today_kiev():
+            STATS.update({"relayed_date": get_today_kiev(), "relayed_in_today": 0, "relayed_out_today": 0})
+
+        active = STATS["users"] - STATS["muted"] - STATS["banned"]
+        ratings = STATS.get("ratings", {})
+        num_of_ratings = sum(ratings.values())
+        average_rating = sum(float(r) * n for r, n in ratings.items()) / num_of_ratings if num_of_ratings else 0
+        ratings_text = "\n".join(
+            f"{rating}⭐️: {ratings[rating]}" for rating in sorted(ratings, key=float, reverse=True) if ratings[rating]
+        ) or "Оцінок ще немає."
+
+        await update.message.reply_text(
+            f"📊 Статистика бота:\n"
+            f"👥 Користувачів: {STATS['users']}\n"
+            f"✅ Активних: {active}\n"
+            f"🔇 Замучених: {STATS['muted']}\n"
+            f"🚫 Забанених: {STATS['banned']}\n"
+            f"🗂 Тем: {STATS['topics']}\n"
+            f"📨 Переслано сьогодні: {STATS['relayed_in_today']} від користувачів, "
+            f"{STATS['relayed_out_today']} від адміністрації\n"
+            f"📬 Переслано всього: {STATS['relayed_total']}\n\n"
+            f"🌟 Оцінки (середня {round(average_rating, 1)}⭐️):\n{ratings_text}"
+        )
+    except Exception as e:
+        print(f"Помилка в stats: {e}")
+        await update.message.reply_text("Сталася помилка при обробці команди.")
+
+async def reconcile(update: Update, context: CallbackContext):
+    """Обробка команди /reconcile - застосування банів і мутів з даних у чаті"""
+    try:
+        user = update.message.from_user
+        if not is_programmer(user) and not is_admin(user):
+            await update.message.reply_text("Ця команда доступна лише адміністраторам.")
+            return
+
+        await run_reconciliation(context.bot, update.message)
+    except Exception as e:
+        print(f"Помилка в reconcile: {e}")
+        await update.message.reply_text("❌ Сталася помилка при узгодженні стану чату.")
+
+# ПОШУК КОРИСТУВАЧІВ
+def search_terms_for(user_id, username, first_name):
+    """Терміни пошуку користувача: id, username без @ та слова імені"""
+    terms = {str(user_id)}
+    if username and username != "Не вказано":
+        terms.add(username.lstrip("@").casefold())
+    if first_name and first_name != "Не вказано":
+        name = first_name.casefold()
+        terms.add(name)
+        terms.update(name.split())
+    return terms
+
+def trigrams(term):
+    """Триграми терміну з доповненням пробілами по краях"""
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def search_index_update(user_id, username, first_name):
+    """Інкрементальне оновлення пошукового індексу для одного користувача"""
+    if not search_index["built"]:
+        return
+
+    user_id = str(user_id)
+    new_terms = search_terms_for(user_id, username, first_name)
+    old_terms = search_index["terms"].get(user_id, set())
+    if new_terms == old_terms:
+        return
+
+    for term in old_terms - new_terms:
+        node = search_index["trie"]
+        for char in term:
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            node.get("", set()).discard(user_id)
+        for gram in trigrams(term):
+            search_index["trigrams"].get(gram, set()).discard(user_id)
+
+    for term in new_terms - old_terms:
+        node = search_index["trie"]
+        for char in term:
+            node = node.setdefault(char, {})
+        node.setdefault("", set()).add(user_id)
+        for gram in trigrams(term):
+            search_index["trigrams"].setdefault(gram, set()).add(user_id)
+
+    search_index["terms"][user_id] = new_terms
+
+def ensure_search_index():
+    """Побудова пошукового індексу при першому використанні"""
+    if search_index["built"]:
+        return
+    search_index.update({"built": True, "trie": {}, "trigrams": {}, "terms": {}})
+    for user_id, user in get_list_indexes()["users"].items():
+        search_index_update(user_id, user.username, user.first_name)
+
+def rebuild_search_index():
+    """Скидання пошукового індексу (після імпорту), буде побудований заново при наступному пошуку"""
+    search_index.update({"built": False, "trie": {}, "trigrams": {}, "terms": {}})
+
+def search_users(query, limit=FIND_RESULTS_LIMIT):
+    """Пошук користувачів: префіксний по trie, потім нечіткий по триграмах"""
+    ensure_search_index()
+    query = query.lstrip("@").casefold().strip()
+    if not query:
+        return []
+
+    results = []
+
+    # Префіксний пошук: O(len(query)) до вузла, далі збираємо не більше limit результатів
+    node = search_index["trie"]
+    for char in query:
+        node = node.get(char)
+        if node is None:
+            break
+    if node is not None:
+        stack = [node]
+        while stack and len(results) < limit:
+            current = stack.pop()
+            for user_id in current.get("", ()):
+                if user_id not in results:
+                    results.append(user_id)
+            stack.extend(child for key, child in current.items() if key)
+
+    # Нечіткий пошук по спільних триграмах
+    if len(results) < limit and len(query) >= 3:
+        query_grams = trigrams(query)
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(search_index["trigrams"].get(gram, ()))
+        scored = []
+        for user_id, _ in shared.most_common(limit * 5):
+            if user_id in results:
+                continue
+            similarity = max(
+                len(query_grams & trigrams(term)) / len(query_grams | trigrams(term))
+                for term in search_index["terms"].get(user_id, ())
+            )
+            if similarity >= 0.3:
+                scored.append((similarity, user_id))
+        scored.sort(reverse=True)
+        results.extend(user_id for _, user_id in scored[:limit - len(results)])
+
+    return results[:limit]
+
+def topic_link(chat_id, topic_id):
+    """Посилання на тему форуму в супергрупі"""
+    internal_id = str(chat_id)
+    if internal_id.startswith("-100"):
+        internal_id = internal_id[4:]
+    return f"https://t.me/c/{internal_id.lstrip('-')}/{topic_id}"
+
+async def find(update: Update, context: CallbackContext):
+    """Обробка команди /find <запит> - пошук користувача за username, ім'ям або id"""
+    try:
+        user = update.message.from_user
+        if not is_programmer(user) and not is_admin(user):
+            await update.message.reply_text("Ця команда доступна лише адміністраторам.")
+            return
+
+        if not context.args:
+            await update.message.reply_text("Використовуйте: /find <username, ім'я або id>")
+            return
+
+        query = " ".join(context.args)
+        found = search_users(query)
+        if not found:
+            await update.message.reply_text(f"За запитом «{query}» нікого не знайдено.")
+            return
+
+        indexes = get_list_indexes()
+        response = f"🔎 Результати пошуку «{query}»:\n"
+        for user_id in found:
+            user_data = indexes["users"].get(user_id)
+            topic_id = indexes["topics"].get(user_id)
+            first_name, username = (user_data.first_name, user_data.username) if user_data else ("Невідомий", NOT_SPECIFIED)
+            response += f"👤 {first_name}; @{username} {user_id}\n"
+            response += f"🗂 {topic_link(indexes['chat_id'], topic_id)}\n" if topic_id else "🗂 Теми ще немає\n"
+
+        await update.message.reply_text(response, disable_web_page_preview=True)
+    except Exception as e:
+        print(f"Помилка в find: {e}")
+        await update.message.reply_text("Сталася помилка при обробці команди.")
 
 async def get_alllist(update: Update, context: CallbackContext):
-    """Обробка команди /get_alllist з покращеною обробкою помилок"""
+    """Обробка команди /get_alllist [формат] [фільтри] з покращеною обробкою помилок.
+    Приклад: /get_alllist csv status=muted since=7d rating<3 sheets=users"""
     try:
+        try:
+            fmt, export_filters = parse_export_args(context.args or [])
+        except ValueError as e:
+            await update.message.reply_text(
+                f"❌ {e}\nВикористання: /get_alllist [{'|'.join(EXPORT_FORMATS)}] [status=muted] [since=7d] "
+                f"[rating<3] [sheets={','.join(EXPORT_SHEET_GROUPS)}]"
+            )
+            return
+        if fmt == "parquet" and not PARQUET_AVAILABLE:
+            await update.message.reply_text("Формат Parquet недоступний: на сервері не встановлено pyarrow.")
+            return
+
         # Відправляємо повідомлення про початок створення звіту
         processing_msg = await update.message.reply_text("⏳ Створення звіту...")
 
-        # Створюємо звіт
-        excel_filename = await export_to_excel()
+        # Створюємо звіт (або беремо з кешу, якщо дані не змінювались)
+        entry = await get_cached_export(fmt, export_filters)
 
-        if excel_filename:
+        if entry:
             try:
-                with open(excel_filename, "rb") as file:
-                    # Видаляємо повідомлення "Створення звіту..."
-                    await context.bot.delete_message(
-                        chat_id=update.effective_chat.id,
-                        message_id=processing_msg.message_id
-                    )
-                    # Відправляємо готовий звіт
-                    await update.message.reply_document(
-                        document=file,
-                        filename=os.path.basename(excel_filename),
-                        caption="📊 Звіт успішно створено"
-                    )
+                # Видаляємо повідомлення "Створення звіту..."
+                await context.bot.delete_message(
+                    chat_id=update.effective_chat.id,
+                    message_id=processing_msg.message_id
+                )
+                # Відправляємо готовий звіт
+                caption = "📊 Звіт успішно створено"
+                if export_filters:
+                    caption += f"\nФільтри: {' '.join(context.args)}"
+                await send_export(update.message.reply_document, entry, caption=caption)
             except Exception as e:
                 logging.error(f"Помилка при відправці файлу: {str(e)}")
                 await context.bot.edit_message_text(
@@ -1457,13 +3057,6 @@ async def get_alllist(update: Update, context: CallbackContext):
                     message_id=processing_msg.message_id,
                     text="❌ Помилка при відправці звіту. Спробуйте ще раз."
                 )
-            finally:
-                # Видаляємо тимчасовий файл
-                if os.path.exists(excel_filename):
-                    try:
-                        os.remove(excel_filename)
-                    except Exception as e:
-                        logging.error(f"Помилка при видаленні файлу: {str(e)}")
         else:
             await context.bot.edit_message_text(
                 chat_id=update.effective_chat.id,
@@ -1481,11 +3074,28 @@ async def get_alllist(update: Update, context: CallbackContext):
             pass
 
 async def set_alllist(update: Update, context: CallbackContext) -> None:
-    """Обробка команди /set_alllist - імпорт даних з Excel файлу"""
+    """Обробка команди /set_alllist [dry] [prune] - імпорт даних з Excel файлу.
+    dry - лише показати різницю без збереження, prune - видалити записи, відсутні у файлі"""
     try:
-        user = update.message.from_user.username
+        user = update.message.from_user
+        if not is_programmer(user) and not is_admin(user):
+            await update.message.reply_text("Ця команда доступна лише адміністраторам.")
+            return
+
+        args = [arg.lower() for arg in (context.args or [])]
+        unknown = [arg for arg in args if arg not in ("dry", "prune")]
+        if unknown:
+            await update.message.reply_text("Використання: /set_alllist [dry] [prune]")
+            return
+        if "prune" in args and not is_programmer(user):
+            await update.message.reply_text("Імпорт з prune (видалення записів) доступний лише програмістам.")
+            return
 
-        await update.message.reply_text("Будь ласка, надішліть Excel-файл з даними.")
+        context.user_data["import_options"] = {"dry_run": "dry" in args, "prune": "prune" in args}
+        mode = " (перевірка без збереження)" if "dry" in args else ""
+        await update.message.reply_text(
+            f"Будь ласка, надішліть файл з даними{mode}: .xlsx, .csv.zip, .jsonl.gz або .parquet.zip."
+        )
         context.user_data["awaiting_file"] = True
     except Exception as e:
         print(f"Помилка в set_alllist: {e}")
@@ -1494,7 +3104,7 @@ async def set_alllist(update: Update, context: CallbackContext) -> None:
 async def get_logs(update: Update, context: CallbackContext):
     """Обробка команди /get_logs - отримання логів"""
     try:
-        user = update.message.from_user.username
+        user = update.message.from_user
         if not is_programmer(user) and not is_admin(user):
             await update.message.reply_text("Ця команда доступна лише адміністраторам.")
             return
@@ -1515,33 +3125,225 @@ async def get_logs(update: Update, context: CallbackContext):
         print(f"Помилка при відправці логів: {e}")
         await update.message.reply_text("❌ Сталася помилка при відправці логів.")
 
+# ПРИДУШЕННЯ ДУБЛІКАТІВ
+def simhash(text):
+    """64-бітний SimHash тексту за символьними триграмами (враховуються перші 1000 символів)"""
+    text = " ".join(re.sub(r'[^\w\s]', '', text[:1000]).split())
+    weights = [0] * 64
+    for i in range(max(1, len(text) - 2)):
+        h = int.from_bytes(hashlib.blake2b(text[i:i + 3].encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+def message_fingerprint(message):
+    """Відбиток повідомлення: (ключ точного збігу, simhash або None, чи враховувати між користувачами).
+    SimHash рахується лише для довгих текстів: короткі звернення на кшталт "не працює оплата" від різних
+    людей схожі, але не є спамом"""
+    if message.text:
+        normalized = " ".join(message.text.lower().split())
+        fingerprint = simhash(normalized) if (len(normalized.split()) >= DEDUP["simhash_min_tokens"]
+                                              and len(normalized) >= DEDUP["simhash_min_length"]) else None
+        key = "t:" + hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+        return key, fingerprint, len(normalized) >= DEDUP["global_min_length"]
+
+    if message.photo:
+        return "m:" + message.photo[-1].file_unique_id, None, True
+    for media in (message.document, message.voice, message.video, message.video_note):
+        if media:
+            return "m:" + media.file_unique_id, None, True
+    if message.sticker:
+        return "m:" + message.sticker.file_unique_id, None, False
+    return None, None, False
+
+def is_near_duplicate(fingerprint, other):
+    """Перевірка схожості двох SimHash"""
+    return fingerprint is not None and other is not None and \
+        (fingerprint ^ other).bit_count() <= DEDUP["simhash_distance"]
+
+def simhash_bands(fingerprint):
+    """Смуги SimHash: у текстів на відстані не більше simhash_distance хоча б одна смуга збігається"""
+    count = min(DEDUP["simhash_distance"] + 1, 64)
+    bounds = [64 * i // count for i in range(count + 1)]
+    return [(i, (fingerprint >> bounds[i]) & ((1 << (bounds[i + 1] - bounds[i])) - 1)) for i in range(count)]
+
+def check_duplicate_message(user_id, message):
+    """Перевірка повідомлення на дублікат: None, "user" або "global" """
+    key, fingerprint, check_global = message_fingerprint(message)
+    if key is None:
+        return None
+
+    now = time.monotonic()
+
+    # Видаляємо записи, що вийшли за глобальне вікно
+    while dedup_global_recent and (now - dedup_global_recent[0][0] > DEDUP["global_window"]
+                                   or len(dedup_global_recent) > DEDUP["max_recent"]):
+        _, old_key, old_fingerprint, old_user_id = dedup_global_recent.popleft()
+        users = dedup_global_keys.get(old_key)
+        if users is not None:
+            users[old_user_id] -= 1
+            if users[old_user_id] <= 0:
+                del users[old_user_id]
+            if not users:
+                del dedup_global_keys[old_key]
+        if old_fingerprint is not None:
+            for band in simhash_bands(old_fingerprint):
+                seen = dedup_global_bands.get(band)
+                if seen is not None:
+                    seen[(old_fingerprint, old_user_id)] -= 1
+                    if seen[(old_fingerprint, old_user_id)] <= 0:
+                        del seen[(old_fingerprint, old_user_id)]
+                    if not seen:
+                        del dedup_global_bands[band]
+
+    result = None
+
+    user_recent = dedup_user_recent.get(user_id)
+    if user_recent is None:
+        user_recent = dedup_user_recent[user_id] = deque(maxlen=20)
+    # Від одного користувача придушуються лише точні повтори: "замовлення 12345" і "замовлення 12346" - різні звернення
+    for seen_at, seen_key in user_recent:
+        if now - seen_at <= DEDUP["user_window"] and seen_key == key:
+            result = "user"
+            break
+
+    if result is None and check_global:
+        other_users = set(dedup_global_keys.get(key, {})) - {user_id}
+        if fingerprint is not None and len(other_users) < DEDUP["global_users"] - 1:
+            # Перевіряються лише тексти зі спільною смугою, а не все глобальне вікно
+            for band in simhash_bands(fingerprint):
+                for seen_fingerprint, seen_user_id in dedup_global_bands.get(band, ()):
+                    if seen_user_id != user_id and is_near_duplicate(fingerprint, seen_fingerprint):
+                        other_users.add(seen_user_id)
+        if len(other_users) >= DEDUP["global_users"] - 1:
+            result = "global"
+
+    user_recent.append((now, key))
+    if check_global:
+        dedup_global_recent.append((now, key, fingerprint, user_id))
+        dedup_global_keys.setdefault(key, Counter())[user_id] += 1
+        if fingerprint is not None:
+            for band in simhash_bands(fingerprint):
+                dedup_global_bands.setdefault(band, Counter())[(fingerprint, user_id)] += 1
+
+    if len(dedup_user_recent) > 10000:
+        for stale_user_id in [uid for uid, recent in dedup_user_recent.items()
+                              if not recent or now - recent[-1][0] > DEDUP["user_window"]]:
+            del dedup_user_recent[stale_user_id]
+
+    if result:
+        dedup_suppressed[user_id] += 1
+    return result
+
+async def report_suppressed_messages():
+    """Періодичний звіт адміністраторам про придушені дублікати"""
+    if not dedup_suppressed:
+        return
+    try:
+        total = sum(dedup_suppressed.values())
+        top_users = "\n".join(f"• {user_id}: {count}" for user_id, count in dedup_suppressed.most_common(10))
+        dedup_suppressed.clear()
+
+        bot = Bot(token=BOTTOCEN)
+        await bot.send_message(
+            chat_id=CREATOR_CHAT_ID,
+            text=f"🧹 Придушено дублікатів повідомлень: {total}\nНайактивніші відправники:\n{top_users}"
+        )
+    except Exception as e:
+        print(f"Помилка при відправці звіту про дублікати: {e}")
+
 # ОБРОБКА ПОВІДОМЛЕНЬ
+async def check_rate_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Token bucket для вхідних повідомлень користувача: False - повідомлення потрібно відкинути"""
+    user_id = str(update.message.from_user.id)
+    now = time.monotonic()
+    burst = RATE_LIMIT["burst"]
+
+    bucket = rate_buckets.get(user_id)
+    if bucket is None:
+        if len(rate_buckets) > 10000:
+            idle = burst / RATE_LIMIT["refill_per_sec"]
+            for stale_user_id in [uid for uid, b in rate_buckets.items() if now - b["updated"] > idle]:
+                del rate_buckets[stale_user_id]
+        bucket = rate_buckets[user_id] = {"tokens": burst, "updated": now, "drops": 0, "warned": False}
+
+    bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated"]) * RATE_LIMIT["refill_per_sec"])
+    bucket["updated"] = now
+
+    if bucket["tokens"] >= 1:
+        if bucket["tokens"] >= burst:
+            bucket["drops"] = 0
+            bucket["warned"] = False
+        bucket["tokens"] -= 1
+        return True
+
+    bucket["drops"] += 1
+
+    if bucket["drops"] >= RATE_LIMIT["mute_after_drops"]:
+        data = safe_json_read(DATA_FILE)
+        if user_id != data.get("owner_id") and user_id not in get_moderation_views()["banned"]:
+            mute_time = RATE_LIMIT["mute_seconds"]
+            reason = "Автоматичний мут за флуд"
+            mute_end = mute_user_in_data(data, user_id, mute_time, reason)
+            # Автоматичний мут діє лише на пересилання боту, обмеження в чаті для нього не потрібне
+            set_enforced(data, [(user_id, "muted", data["muted_users"][user_id])])
+            save_moderation_changes(data, [(user_id, "muted", data["muted_users"][user_id])])
+            try:
+                await context.bot.send_message(
+                    chat_id=int(user_id),
+                    text=f"🔇 Вас замутили на {mute_time} секунд\n"
+                         f"📌 Причина: {reason}\n"
+                         f"⏳ Мут закінчиться: {mute_end}"
+                )
+            except Exception as e:
+                print(f"Помилка сповіщення про автоматичний мут: {e}")
+        bucket["drops"] = 0
+        bucket["warned"] = True
+        return False
+
+    if not bucket["warned"]:
+        bucket["warned"] = True
+        try:
+            await update.message.reply_text("⚠️ Ви надсилаєте повідомлення занадто часто. Зачекайте трохи.")
+        except Exception as e:
+            print(f"Помилка попередження про флуд: {e}")
+    return False
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обробка всіх повідомлень"""
     try:
+        if update.message.chat.type == "private" and not await check_rate_limit(update, context):
+            return
+
         sent_messages = load_sent_messages()
-        muted_users = load_muted_users_from_file()
         data = safe_json_read(DATA_FILE)
 
         if context.user_data.get("awaiting_file"):
             if update.message.document:
+                # Роль перевіряється ще раз: імпорт змінює дані та застосовує бани й мути в чаті
+                sender = update.message.from_user
+                options = context.user_data.get("import_options", {})
+                if not (is_programmer(sender) or (is_admin(sender) and not options.get("prune"))):
+                    context.user_data["awaiting_file"] = False
+                    context.user_data.pop("import_options", None)
+                    await update.message.reply_text("Імпорт доступний лише адміністраторам, prune - лише програмістам.")
+                    return
+
                 file = await update.message.document.get_file()
-                await file.download_to_drive("temp_import.xlsx")
+                content = bytes(await file.download_as_bytearray())
 
-                if await import_from_excel("temp_import.xlsx"):
-                    await update.message.reply_text("Дані успішно імпортовано!")
-                else:
-                    await update.message.reply_text("Помилка при імпорті даних")
+                options = context.user_data.pop("import_options", {})
+                fmt = detect_file_format(update.message.document.file_name)
+                success, report = await import_from_file(content, fmt, **options)
+                await update.message.reply_text(report)
 
                 context.user_data["awaiting_file"] = False
-                try:
-                    os.remove("temp_import.xlsx")
-                except:
-                    pass
+                if success and not options.get("dry_run") and (is_programmer(sender) or is_admin(sender)):
+                    await run_reconciliation(context.bot, update.message)
                 return
 
-        if update.message.message_thread_id == ALLUSERS_TEM_ID and is_programmer(update.message.from_user.username):
-            user = update.message.from_user.username
+        if update.message.message_thread_id == ALLUSERS_TEM_ID and is_programmer(update.message.from_user):
+            user = update.message.from_user
             if is_programmer(user) or is_admin(user):
                 success_count = 0
                 fail_count = 0
@@ -1640,8 +3442,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if str(update.message.chat.id) != str(data["chat_id"]):
             user_id = update.message.from_user.id
-            if str(user_id) in muted_users and muted_users[str(user_id)]['expiration'] and muted_users[str(user_id)][
-                'expiration'] > datetime.now():
+            if is_user_restricted(str(user_id)):
                 reply = await update.message.reply_text("Ви в муті й не можете надсилати повідомлення.")
                 await asyncio.create_task(
                     auto_delete_message(context.bot, chat_id=reply.chat.id, message_id=reply.message_id, delay=10))
@@ -1652,26 +3453,41 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 user_username = update.effective_user.username if update.effective_user.username else "немає імені користувача"
                 current_time = get_current_time_kiev()
 
-                def escape_markdown(text):
-                    if not text:
-                        return ""
-                    escape_chars = r'_*[]()~`>#+-=|{}.!'
-                    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
+                duplicate = check_duplicate_message(str(user_id), update.message)
+                if duplicate:
+                    print(f"Придушено дублікат ({duplicate}) від {user_id}")
+                    # Відправник завжди бачить, що повідомлення не переслано і чому
+                    if duplicate == "user":
+                        await acknowledge_message(context.bot, update.message,
+                                                  "👀 Це повідомлення вже надіслано, повтор не пересилається.",
+                                                  reaction=ACK_REACTION_DUPLICATE)
+                    else:
+                        await acknowledge_message(
+                            context.bot, update.message,
+                            "⚠️ Повідомлення не переслано: таке саме щойно надіслали кілька користувачів. "
+                            "Якщо у вас окреме питання, опишіть його своїми словами.",
+                            success=False, delay=None)
+                    return
 
                 topic_id = await get_or_create_topic(context, user_id, user_name)
 
                 if topic_id:
                     base_message = f'📩 Повідомлення від **{escape_markdown(user_name)}**; `@{escape_markdown(user_username)}` `{user_id}`\n⏰ {escape_markdown(current_time)}:'
+                    if not update.message.text:
+                        # Після медіа наступний текст іде новим постом, інакше він опиниться в темі вище за медіа
+                        coalesced_posts.pop(user_id, None)
                     if update.message.text:
-                        message_text = f'{base_message}\n{escape_markdown(update.message.text)}'
-                        msg = await context.bot.send_message(
+                        post_id, is_new_post = await relay_text_coalesced(
+                            context.bot,
                             chat_id=data["chat_id"],
-                            message_thread_id=topic_id,
-                            text=message_text,
-                            parse_mode="MarkdownV2"
+                            topic_id=topic_id,
+                            user_id=user_id,
+                            base_message=base_message,
+                            text=escape_markdown(update.message.text)
                         )
-                        sent_messages[str(msg.message_id)] = user_id
-                        save_sent_messages(sent_messages)
+                        if is_new_post:
+                            sent_messages[str(post_id)] = user_id
+                            save_sent_messages(sent_messages)
                     elif update.message.photo:
                         photo_file_id = update.message.photo[-1].file_id
                         caption = update.message.caption if update.message.caption else ''
@@ -1755,15 +3571,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         )
                         save_sent_messages(sent_messages)
 
-                    reply = await update.message.reply_text("✅ Ваше повідомлення надіслано адміністраторам бота.")
-                    await asyncio.create_task(
-                        auto_delete_message(context.bot, chat_id=reply.chat.id, message_id=reply.message_id, delay=5))
+                    stats_count_relay("in")
+                    await acknowledge_message(
+                        context.bot, update.message, "✅ Ваше повідомлення надіслано адміністраторам бота.")
             else:
                 await update.message.reply_text("Введіть /message, щоб надсилати повідомлення адміністраторам бота.")
             return
 
         if update.message.message_thread_id is not None:
-            user = update.message.from_user.username
+            user = update.message.from_user
             if not is_programmer(user) and not is_admin(user):
                 return
 
@@ -1812,10 +3628,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             video_note=update.message.video_note.file_id
                         )
 
-                    sent_msg = await update.message.reply_text("Повідомлення відправлено користувачу")
-                    asyncio.create_task(auto_delete_message(context.bot, chat_id=sent_msg.chat.id, message_id=sent_msg.message_id, delay=5))
+                    stats_count_relay("out")
+                    await acknowledge_message(context.bot, update.message, "Повідомлення відправлено користувачу")
                 except Exception as e:
-                    await update.message.reply_text(f"Помилка при відправці: {str(e)}")
+                    print(f"Помилка при відправці користувачу {user_id}: {e}")
+                    await acknowledge_message(
+                        context.bot, update.message, f"Помилка при відправці: {str(e)}", success=False, delay=None)
             return
 
         if update.message.reply_to_message and update.message.reply_to_message.from_user.id == context.bot.id:
@@ -1871,15 +3689,61 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             text=reply_text
                         )
 
-                    await update.message.reply_text(f"Користувачу {user_name} було надіслано повідомлення")
+                    stats_count_relay("out")
+                    await acknowledge_message(
+                        context.bot, update.message, f"Користувачу {user_name} було надіслано повідомлення", delay=None)
                     sent_messages[str(update.message.message_id)] = update.message.from_user.id
                     save_sent_messages(sent_messages)
                 except Exception as e:
-                    await update.message.reply_text(f"Помилка при відправці: {str(e)}")
+                    print(f"Помилка при відправці користувачу {original_user_id}: {e}")
+                    await acknowledge_message(
+                        context.bot, update.message, f"Помилка при відправці: {str(e)}", success=False, delay=None)
     except Exception as e:
         print(f"Помилка в handle_message: {str(e)}")
 
 
+async def relay_text_coalesced(bot, chat_id, topic_id, user_id, base_message, text):
+    """Пересилання тексту в тему з об'єднанням повідомлень, що надійшли в межах вікна COALESCE_WINDOW"""
+    now = time.monotonic()
+    post = coalesced_posts.get(user_id)
+
+    if post and post["topic_id"] == topic_id and now - post["updated"] <= COALESCE_WINDOW:
+        merged_text = f'{post["text"]}\n{text}'
+        if len(merged_text) <= MAX_MESSAGE_LENGTH:
+            try:
+                await bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=post["message_id"],
+                    text=merged_text,
+                    parse_mode="MarkdownV2"
+                )
+                post["text"] = merged_text
+                post["updated"] = now
+                return post["message_id"], False
+            except telegram.error.BadRequest as e:
+                print(f"Не вдалося доповнити повідомлення {post['message_id']}: {e}")
+
+    message_text = f'{base_message}\n{text}'
+    msg = await bot.send_message(
+        chat_id=chat_id,
+        message_thread_id=topic_id,
+        text=message_text,
+        parse_mode="MarkdownV2"
+    )
+
+    if COALESCE_WINDOW > 0:
+        if len(coalesced_posts) > 1000:
+            for stale_user_id in [uid for uid, p in coalesced_posts.items() if now - p["updated"] > COALESCE_WINDOW]:
+                del coalesced_posts[stale_user_id]
+        coalesced_posts[user_id] = {
+            "message_id": msg.message_id,
+            "topic_id": topic_id,
+            "text": message_text,
+            "updated": now
+        }
+
+    return msg.message_id, True
+
 async def get_or_create_topic(context: ContextTypes.DEFAULT_TYPE, user_id: int, first_name: str):
     """Створення або отримання теми для користувача з обробкою блокувань"""
     try:
@@ -1916,14 +3780,19 @@ async def get_or_create_topic(context: ContextTypes.DEFAULT_TYPE, user_id: int,
             )
             topic_id = forum_topic.message_thread_id
 
-            try:
-                user_info = await context.bot.get_chat(user_id)
-                username = user_info.username or "немає username"
-                full_name = user_info.full_name or first_name
-            except Exception as e:
-                print(f"Error getting user info: {e}")
-                username = "немає username"
-                full_name = first_name
+            profile = profile_directory.get(str(user_id))
+            if profile:
+                username = profile["username"] if profile["username"] != "Не вказано" else "немає username"
+                full_name = profile["full_name"]
+            else:
+                try:
+                    user_info = await context.bot.get_chat(user_id)
+                    username = user_info.username or "немає username"
+                    full_name = user_info.full_name or first_name
+                except Exception as e:
+                    print(f"Error getting user info: {e}")
+                    username = "немає username"
+                    full_name = first_name
 
             info_message = (
                 f"📌 Інформація про користувача:\n"
@@ -1956,6 +3825,8 @@ async def get_or_create_topic(context: ContextTypes.DEFAULT_TYPE, user_id: int,
             if not safe_json_write(data, DATA_FILE):
                 print("Failed to save data to JSON file")
             else:
+                stats_bump("topics")
+                invalidate_list_indexes()
                 print("Successfully updated topic data")
 
             return topic_id
@@ -1972,68 +3843,195 @@ async def get_or_create_topic(context: ContextTypes.DEFAULT_TYPE, user_id: int,
         return None
 
 # НАЛАШТУВАННЯ КОМАНД БОТА
-async def set_default_commands(application):
-    """Встановлення стандартних команд для звичайних користувачів"""
-    try:
-        commands = [
+def bot_command_sets():
+    """Списки команд для кожної області видимості: {назва: (команди, область)}"""
+    return {
+        # Стандартні команди для звичайних користувачів
+        "default": ([
             BotCommand("start", "Запустити бота"),
             BotCommand("rate", "Залишити відгук"),
             BotCommand("message", "Почати введення повідомлень адміністраторам"),
             BotCommand("stopmessage", "Завершити введення повідомлень"),
             BotCommand("fromus", "Інформація про створювача"),
             BotCommand("help", "Показати доступні команди"),
-        ]
-        await application.bot.set_my_commands(commands, scope=BotCommandScopeDefault())
-    except Exception as e:
-        print(f"Помилка в set_default_commands: {e}")
-
-async def set_creator_commands(application):
-    """Встановлення команд для адміністраторів"""
-    try:
-        commands = [
+        ], BotCommandScopeDefault()),
+        # Команди для адміністраторів
+        "creator": ([
             BotCommand("mutelist", "Показати список замучених користувачів"),
             BotCommand("mute", "Замутити користувача"),
             BotCommand("unmute", "Розмутити користувача"),
             BotCommand("ban", "Забанити користувача"),
             BotCommand("unban", "Розбанити користувача"),
             BotCommand("alllist", "Показати всіх користувачів"),
+            BotCommand("find", "Знайти користувача"),
+            BotCommand("stats", "Статистика бота"),
+            BotCommand("reconcile", "Застосувати бани та мути з даних"),
             BotCommand("fromus", "Інформація про створювача"),
             BotCommand("help", "Показати доступні команди"),
             BotCommand("info", "Показати інформацію про програмістів та адміністраторів"),
             BotCommand("get_alllist", "Отримати Excel файл з користувачами"),
             BotCommand("set_alllist", "Записати Excel файл з користувачами"),
-        ]
-        await application.bot.set_my_commands(commands, scope=BotCommandScopeChat(chat_id=CREATOR_CHAT_ID))
+        ], BotCommandScopeChat(chat_id=CREATOR_CHAT_ID)),
+        # Команди для чату збереження
+        "save": ([
+            BotCommand("get_alllist", "Отримати Exel файл з користувачами"),
+            BotCommand("set_alllist", "Записати Exel файл з користувачами"),
+            BotCommand("get_logs", "Отримати логи"),
+            BotCommand("help", "Показати доступні команди"),
+        ], BotCommandScopeChat(chat_id=CAVE_CHAT_ID)),
+    }
+
+def command_set_hash(bot_id, commands, scope):
+    """Хеш списку команд разом з ботом і областю видимості (зміна токена чи ID чату теж вимагає завантаження)"""
+    payload = json.dumps({"bot": bot_id, "scope": scope.to_dict(),
+                          "commands": [command.to_dict() for command in commands]},
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+async def upload_command_set(bot, name, commands, scope):
+    """Завантаження одного списку команд; повертає True при успіху"""
+    try:
+        await bot.set_my_commands(commands, scope=scope)
+        return True
     except Exception as e:
-        print(f"Помилка в set_creator_commands: {e}")
-
-async def set_save_commands(application):
-    """Встановлення команд для адміністраторів"""
-    commands = [
-        BotCommand("get_alllist", "Отримати Exel файл з користувачами"),
-        BotCommand("set_alllist", "Записати Exel файл з користувачами"),
-        BotCommand("get_logs", "Отримати логи"),
-        BotCommand("help", "Показати доступні команди"),
-    ]
-    await application.bot.set_my_commands(commands, scope=BotCommandScopeChat(chat_id=CAVE_CHAT_ID))
+        print(f"Помилка при встановленні команд ({name}): {e}")
+        return False
+
+async def sync_bot_commands(bot):
+    """Завантаження списків команд у Telegram лише тоді, коли вони змінилися з попереднього запуску.
+    Хеші завантажених списків зберігаються в data["command_hashes"]; змінені списки завантажуються одночасно"""
+    try:
+        command_sets = bot_command_sets()
+        hashes = {name: command_set_hash(bot.id, commands, scope) for name, (commands, scope) in command_sets.items()}
+        cached = safe_json_read(DATA_FILE).get("command_hashes", {})
+        changed = [name for name in command_sets if cached.get(name) != hashes[name]]
+        if not changed:
+            return
+
+        results = await asyncio.gather(*(upload_command_set(bot, name, *command_sets[name]) for name in changed))
+        uploaded = [name for name, ok in zip(changed, results) if ok]
+        if uploaded:
+            # Невдалі списки не запам'ятовуються - вони завантажаться при наступному запуску
+            data = safe_json_read(DATA_FILE)
+            data.setdefault("command_hashes", {}).update({name: hashes[name] for name in uploaded})
+            safe_json_write(data, DATA_FILE)
+    except Exception as e:
+        print(f"Помилка в sync_bot_commands: {e}")
+
+async def start_background_setup(application):
+    """post_init: налаштування, на які не треба чекати перед початком polling"""
+    global command_sync_task
+    command_sync_task = asyncio.create_task(sync_bot_commands(application.bot))
+
+def make_report_watermark(data, last_full):
+    """Знімок стану після звіту: з ним порівнюється наступний нічний звіт"""
+    views = build_moderation_views(data)
+    return {
+        "date": get_today_kiev(),
+        "last_full": last_full,
+        "ratings": {str(user["id"]): user.get("rating", 0) for user in data.get("users", [])},
+        "muted": {user_id: info.expiration for user_id, info in views["muted"].items()},
+        "banned": list(views["banned"]),
+        "topics": list(data.get("topics", {}))
+    }
+
+def build_delta_report(data, watermark):
+    """Зміни з моменту попереднього звіту: {назва аркуша: (колонки, рядки)}; порожні аркуші пропускаються"""
+    views = build_moderation_views(data)
+    users = {str(user["id"]): user for user in data.get("users", [])}
+    ratings = watermark.get("ratings", {})
+    muted_before = watermark.get("muted", {})
+    banned_before = set(watermark.get("banned", []))
+    topics_before = set(watermark.get("topics", []))
+
+    def username(user_id):
+        return users.get(user_id, {}).get("username")
+
+    sheets = {
+        "NewUsers": (["id", "username", "first_name", "join_date", "rating"], [
+            (user_id, user.get("username"), user.get("first_name"), user.get("join_date"), user.get("rating"))
+            for user_id, user in users.items() if user_id not in ratings
+        ]),
+        "RatingChanges": (["id", "username", "old_rating", "new_rating"], [
+            (user_id, user.get("username"), ratings[user_id], user.get("rating", 0))
+            for user_id, user in users.items() if user_id in ratings and ratings[user_id] != user.get("rating", 0)
+        ]),
+        "Mutes": (["id", "username", "mute_end", "reason"], [
+            (user_id, username(user_id), info.expiration, info.reason)
+            for user_id, info in views["muted"].items()
+            if user_id not in muted_before or muted_before[user_id] != info.expiration
+        ]),
+        "Unmutes": (["id", "username"], [
+            (user_id, username(user_id)) for user_id in muted_before
+            if user_id not in views["muted"] and user_id not in views["banned"]
+        ]),
+        "Bans": (["id", "username", "reason", "date"], [
+            (user_id, username(user_id), info.reason, info.date)
+            for user_id, info in views["banned"].items() if user_id not in banned_before
+        ]),
+        "Unbans": (["id", "username"], [
+            (user_id, username(user_id)) for user_id in banned_before if user_id not in views["banned"]
+        ]),
+        "NewTopics": (["user_id", "username", "topic_id"], [
+            (user_id, username(user_id), topic_id)
+            for user_id, topic_id in data.get("topics", {}).items() if user_id not in topics_before
+        ]),
+    }
+    return {name: sheet for name, sheet in sheets.items() if sheet[1]}
+
+def build_delta_workbook(sheets, cancel_event=None):
+    """Невеликий write-only Excel файл зі змінами; повертає вміст файлу"""
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    for sheet_name, (columns, rows) in sheets.items():
+        write_excel_sheet(workbook, sheet_name, columns, rows, stream_column_widths(columns, rows),
+                          cancel_event=cancel_event)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
 
 async def send_user_list():
-    """Автоматична відправка Excel файлу з користувачами"""
+    """Автоматична відправка звіту з користувачами: повний Excel раз на REPORTS["full_every_days"] днів,
+    у решту ночей - лише зміни з моменту попереднього звіту"""
     try:
-        excel_filename = await export_to_excel()
-        if excel_filename:
-            bot = Bot(token=BOTTOCEN)
-            with open(excel_filename, "rb") as file:
-                filename_to_send = os.path.basename(excel_filename)
+        bot = Bot(token=BOTTOCEN)
+        data = safe_json_read(DATA_FILE)
+        watermark = read_side_file(REPORT_WATERMARK_FILE) or data.get("report_watermark")
+        today = datetime.now(pytz.timezone('Europe/Kiev')).date()
+
+        full_due = (
+            not REPORTS["delta"] or not watermark or
+            (today - datetime.strptime(watermark["last_full"], "%Y-%m-%d").date()).days >= REPORTS["full_every_days"]
+        )
+
+        # Знімок береться з тих самих даних, що й звіт: зміни, записані під час відправки, потраплять у наступний
+        if full_due:
+            snapshot = make_report_watermark(data, get_today_kiev())
+            entry = await get_cached_export()
+            if not entry:
+                return
+            await send_export(bot.send_document, entry, chat_id=CAVE_CHAT_ID)
+        else:
+            snapshot = make_report_watermark(data, watermark["last_full"])
+            sheets = build_delta_report(data, watermark)
+            period = f"{watermark['date']} — {get_today_kiev()}"
+            if not sheets:
+                await bot.send_message(chat_id=CAVE_CHAT_ID, text=f"📊 Змін за {period} немає.")
+            else:
+                content = await run_excel_job(build_delta_workbook, sheets)
+                summary = "\n".join(f"{name}: {len(rows)}" for name, (columns, rows) in sheets.items())
                 await bot.send_document(
                     chat_id=CAVE_CHAT_ID,
-                    document=file,
-                    filename=filename_to_send
+                    document=content,
+                    filename=f"SupportBot_delta_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.xlsx",
+                    caption=f"📊 Зміни за {period}\n{summary}"
                 )
-            try:
-                os.remove(excel_filename)
-            except Exception as e:
-                print(f"Помилка при видаленні файлу: {e}")
+
+        if safe_json_write(snapshot, REPORT_WATERMARK_FILE) and "report_watermark" in data:
+            # Старі версії тримали знімок у data.json
+            data = safe_json_read(DATA_FILE)
+            data.pop("report_watermark", None)
+            safe_json_write(data, DATA_FILE)
     except Exception as e:
         print(f"Помилка при відправці списку користувачів: {e}")
         try:
@@ -2046,8 +4044,9 @@ async def send_user_list():
 async def main():
     """Головна функція для запуску бота"""
     try:
-        application = Application.builder().token(BOTTOCEN).build()
+        application = Application.builder().token(BOTTOCEN).post_init(start_background_setup).build()
 
+        application.add_handler(TypeHandler(Update, track_profile), group=-1)
         application.add_handler(CommandHandler("start", start))
         application.add_handler(CommandHandler("rate", rate))
         application.add_handler(CommandHandler("message", message))
@@ -2060,6 +4059,9 @@ async def main():
         application.add_handler(CommandHandler("unban", unban))
         application.add_handler(CommandHandler("mutelist", mutelist))
         application.add_handler(CommandHandler("alllist", alllist))
+        application.add_handler(CommandHandler("find", find))
+        application.add_handler(CommandHandler("stats", stats))
+        application.add_handler(CommandHandler("reconcile", reconcile))
         application.add_handler(CommandHandler("admin", admin))
         application.add_handler(CommandHandler("deleteadmin", deleteadmin))
         application.add_handler(CommandHandler("programier", programier))
@@ -2069,16 +4071,17 @@ async def main():
         application.add_handler(CommandHandler("set_alllist", set_alllist))
         application.add_handler(CommandHandler("get_logs", get_logs))
 
-        application.add_handler(CallbackQueryHandler(button_callback))
+        application.add_handler(CallbackQueryHandler(list_page_callback, pattern=r"^list:"))
+        application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^\d+(\.\d+)?$"))
         application.add_handler(MessageHandler(filters.ALL, handle_message))
 
-        await set_default_commands(application)
-        await set_creator_commands(application)
-        await set_save_commands(application)
+        migrate_enforced()
 
         scheduler = AsyncIOScheduler(timezone=pytz.timezone("Europe/Kyiv"))
         scheduler.add_job(send_user_list, "cron", hour=0, minute=0)
         scheduler.add_job(check_mute_expirations, "interval", minutes=1)
+        scheduler.add_job(flush_pending_changes, "interval", minutes=1)
+        scheduler.add_job(report_suppressed_messages, "interval", minutes=DEDUP["report_interval_minutes"])
         scheduler.start()
 
         application.run_polling()
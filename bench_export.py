@@ -0,0 +1,134 @@
+"""Порівняння швидкості підготовки даних для експорту в Excel.
+
+Запуск: python bench_export.py [кількість_користувачів ...] > bench_output.txt
+За замовчуванням міряються 10 000 та 100 000 синтетичних користувачів.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+# TgBot3 при імпорті створює data.json та лог у поточній теці - працюємо у тимчасовій
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BOT_DIR)
+os.chdir(tempfile.mkdtemp(prefix="bench_export_"))
+
+import TgBot3  # noqa: E402
+
+
+def make_dataset(count, seed=42):
+    """Синтетичні дані: ~5% замучених, ~2% забанених, частина без запису в users"""
+    rnd = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    users, muted, banned = [], {}, {}
+    for i in range(count):
+        user_id = str(1_000_000 + i)
+        join = start + timedelta(minutes=rnd.randrange(500_000))
+        users.append({
+            "id": user_id,
+            "username": f"user{i}",
+            "first_name": f"Name{i}",
+            "join_date": join.strftime("%H:%M; %d/%m/%Y"),
+            "rating": rnd.randint(0, 5),
+        })
+        roll = rnd.random()
+        if roll < 0.05:
+            muted[user_id] = {
+                "expiration": (join + timedelta(days=rnd.randrange(1, 30))).strftime("%H:%M; %d/%m/%Y"),
+                "reason": "spam",
+            }
+        elif roll < 0.07:
+            banned[user_id] = {"reason": "abuse"}
+    for i in range(count // 100):
+        banned[str(9_000_000 + i)] = {"reason": "unknown user"}
+
+    data = {
+        "users": users,
+        "admins": ["user1"],
+        "programmers": ["user2"],
+        "topics": {u["id"]: 100 + n for n, u in enumerate(users[: count // 2])},
+        "user_topics": {str(100 + n): u["id"] for n, u in enumerate(users[: count // 2])},
+        "sent_messages": {str(n): users[n % count]["id"] for n in range(count * 2)},
+        "muted_users": muted,
+        "banned_users": banned,
+    }
+    return data, {"muted": muted, "banned": banned}
+
+
+def legacy_prepare_export_frames(data, views):
+    """Попередня реалізація: пошук по рядках, lambda над словниками та strptime для кожної комірки"""
+    all_users_df = pd.DataFrame(data["users"]).reset_index(drop=True)
+    banned_ids = set(views["banned"])
+    muted_ids = set(views["muted"])
+    all_users_df['id'] = all_users_df['id'].astype(str)
+    all_users_df.insert(5, "mute/ban", all_users_df["id"].isin(muted_ids | banned_ids))
+    all_users_df.insert(6, "mute/ban_end", all_users_df["id"].apply(
+        lambda uid: views["muted"].get(uid, {}).get("expiration")
+    ))
+    all_users_df.insert(7, "reason", all_users_df["id"].apply(
+        lambda uid: views["banned"].get(uid, {}).get("reason") or
+                    views["muted"].get(uid, {}).get("reason")
+    ))
+    for user_id in banned_ids:
+        mask = all_users_df['id'] == user_id
+        all_users_df.loc[mask, 'mute/ban'] = True
+        all_users_df.loc[mask, 'mute/ban_end'] = "Назавжди (бан)"
+    all_users_df = all_users_df.reset_index(drop=True)
+    users_df = all_users_df[all_users_df["mute/ban"] == False].copy()
+    muted_df = all_users_df[all_users_df['id'].isin(muted_ids)].copy()
+
+    banned_data = []
+    for user_id, ban_info in views["banned"].items():
+        user_id = str(user_id)
+        user_data = all_users_df[all_users_df["id"] == user_id].iloc[0].to_dict() if not all_users_df[
+            all_users_df["id"] == user_id].empty else {}
+        banned_data.append({
+            "id": user_id,
+            "username": user_data.get("username", "Невідомо"),
+            "first_name": user_data.get("first_name", "Невідомо"),
+            "join_date": user_data.get("join_date", ""),
+            "rating": user_data.get("rating", 0),
+            "mute/ban": True,
+            "mute/ban_end": "Назавжди (бан)",
+            "reason": ban_info.get("reason", "Забанений")
+        })
+    banned_df = pd.DataFrame(banned_data)
+
+    def safe_date_parse(date_str):
+        try:
+            if not date_str or "Назавжди" in str(date_str):
+                return date_str
+            clean_str = date_str.replace(";", "").strip()
+            return datetime.strptime(clean_str, "%H:%M %d/%m/%Y").strftime("%H:%M; %d/%m/%Y")
+        except ValueError:
+            return "Невірний формат"
+
+    for df in [all_users_df, users_df, muted_df, banned_df]:
+        for col in ["mute/ban_end", "join_date"]:
+            if col in df.columns:
+                df[col] = df[col].apply(safe_date_parse)
+    return {"all_users": all_users_df, "users": users_df, "muted": muted_df, "banned": banned_df}
+
+
+def measure(func, *args):
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    print(f"{'users':>8} {'legacy, s':>10} {'vectorised, s':>14} {'speedup':>8}")
+    for size in sizes:
+        data, views = make_dataset(size)
+        legacy = measure(legacy_prepare_export_frames, data, views)
+        vectorised = measure(TgBot3.prepare_export_frames, data, TgBot3.build_moderation_views(data))
+        print(f"{size:>8} {legacy:>10.2f} {vectorised:>14.2f} {legacy / vectorised:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Вимірювання часу імпорту та пам'яті при запуску TgBot3.
+
+Запуск: python bench_startup.py [шлях до TgBot3.py] [кількість запусків]
+Кожен запуск - окремий процес `python -X importtime` у тимчасовій теці (TgBot3 створює там
+data.json та лог). Виводиться медіана повного часу імпорту, час важких пакетів верхнього рівня
+та пікове RSS. Еталонний результат зберігається в bench_startup.txt.
+"""
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_PACKAGES = ["pandas", "numpy", "openpyxl", "flask", "telegram", "apscheduler", "pytz"]
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def measure_once(bot_path):
+    """Один запуск: (час імпорту TgBot3 у мс, {пакет: мс}, пікове RSS у МБ)"""
+    bot_dir = os.path.dirname(os.path.abspath(bot_path))
+    code = (
+        "import resource, sys\n"
+        f"sys.path.insert(0, {bot_dir!r})\n"
+        "import TgBot3\n"
+        "print('RSS_KB', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, file=sys.stderr)\n"
+    )
+    with tempfile.TemporaryDirectory(prefix="bench_startup_") as work_dir:
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                                cwd=work_dir, capture_output=True, text=True, check=True)
+
+    total_ms, packages, rss_mb = 0.0, {}, 0.0
+    for line in result.stderr.splitlines():
+        if line.startswith("RSS_KB"):
+            rss_mb = int(line.split()[1]) / 1024
+            continue
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative_ms, name = int(match.group(2)) / 1000, match.group(4)
+        if name == "TgBot3":
+            total_ms = cumulative_ms
+        elif name in HEAVY_PACKAGES:
+            packages[name] = max(packages.get(name, 0.0), cumulative_ms)
+    return total_ms, packages, rss_mb
+
+
+def main():
+    bot_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                  "TgBot3.py")
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    samples = [measure_once(bot_path) for _ in range(runs)]
+
+    print(f"TgBot3 import, median of {runs} runs")
+    print(f"{'total':<12} {statistics.median(s[0] for s in samples):>8.0f} ms")
+    for package in HEAVY_PACKAGES:
+        times = [s[1].get(package) for s in samples]
+        if all(t is None for t in times):
+            print(f"{package:<12} {'not loaded':>11}")
+        else:
+            print(f"{package:<12} {statistics.median(t or 0.0 for t in times):>8.0f} ms")
+    print(f"{'peak RSS':<12} {statistics.median(s[2] for s in samples):>8.1f} MB")
+
+
+if __name__ == "__main__":
+    main()